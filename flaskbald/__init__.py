@@ -1,14 +1,82 @@
+from __future__ import absolute_import
+
 __version__ = '1.0.0'
 
-import auth
-import celery_ext
-import console
-import db_ext
-import factory
-import log
-import model
-import password
-import response
-import template
-import text
-import validate
+import imp
+import sys
+import time
+from types import ModuleType
+
+# Submodules are imported on first attribute access (flaskbald.factory,
+# `from flaskbald import response`, ...) so that using one part of the
+# package doesn't import the dependencies of all the others.
+submodules = ('auth', 'cache', 'celery_ext', 'compress', 'console', 'db_ext',
+              'encoder', 'factory', 'fragments', 'log', 'metrics', 'model',
+              'password', 'ratelimit', 'response', 'template', 'text',
+              'transaction', 'validate')
+
+__all__ = list(submodules)
+
+# seconds spent importing each submodule, however it was imported
+import_times = {}
+
+
+class ImportTimer(object):
+    '''
+    Meta path finder recording in `import_times` how long the first import
+    of each submodule took, including the submodules it imports in turn.
+    '''
+    def __init__(self, package, path):
+        self.package = package
+        self.path = path
+
+    def find_module(self, fullname, path=None):
+        package, _, name = fullname.rpartition('.')
+        if package == self.package and name in submodules \
+                and fullname not in sys.modules:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        name = fullname.rpartition('.')[2]
+        module_file, pathname, description = imp.find_module(name, self.path)
+        start = time.time()
+        try:
+            return imp.load_module(fullname, module_file, pathname, description)
+        finally:
+            import_times.setdefault(name, time.time() - start)
+            if module_file is not None:
+                module_file.close()
+
+
+class LazyPackage(ModuleType):
+    '''Package module that imports its submodules on demand.'''
+    def __getattr__(self, name):
+        if name not in submodules:
+            raise AttributeError("module '{0}' has no attribute '{1}'".format(
+                self.__name__, name))
+        __import__('{0}.{1}'.format(self.__name__, name))
+        return sys.modules['{0}.{1}'.format(self.__name__, name)]
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(submodules))
+
+
+# swap the package module for the lazy one, keeping a reference to this
+# module so its globals stay alive
+_old_module = sys.modules[__name__]
+_new_module = sys.modules[__name__] = LazyPackage(__name__)
+_new_module.__dict__.update({
+    '__file__': __file__,
+    '__path__': __path__,
+    '__package__': __name__,
+    '__doc__': __doc__,
+    '__version__': __version__,
+    '__all__': __all__,
+    'submodules': submodules,
+    'import_times': import_times,
+    'ImportTimer': ImportTimer,
+    'LazyPackage': LazyPackage,
+    '_old_module': _old_module,
+})
+sys.meta_path.insert(0, ImportTimer(__name__, __path__))
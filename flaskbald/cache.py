@@ -0,0 +1,97 @@
+# encoding: utf-8
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A thread-safe, in-process least-recently-used cache with an optional
+    time-to-live for entries and tag-based invalidation.
+
+    Keeps `hits` and `misses` counters so callers can report hit rates.
+    '''
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''
+        Return the cached value for `key` (marking it as recently used) or
+        `default` when it is missing or expired.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires, tags = entry
+            if expires is not None and expires < time.time():
+                self._untag(key, tags)
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        '''
+        Store `value` under `key`, evicting the least recently used entries
+        beyond `max_entries`. `ttl` overrides the cache default; `tags` are
+        used by :py:meth:`invalidate_tag`.
+        '''
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        tags = tuple(tags)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._untag(key, old[2])
+            self._entries[key] = (value, expires, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.max_entries and len(self._entries) > self.max_entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._untag(evicted_key, evicted[2])
+
+    def invalidate(self, key):
+        '''Drop a single entry.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._untag(key, entry[2])
+
+    def invalidate_tag(self, tag):
+        '''Drop every entry stored with `tag`.'''
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._untag(key, entry[2])
+
+    def clear(self):
+        '''Drop every entry. Counters are kept.'''
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        '''Return the hit/miss counters and current size as a dict.'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
@@ -0,0 +1,190 @@
+# encoding: utf-8
+import zlib
+from werkzeug.datastructures import Headers
+
+
+DEFAULT_MIMETYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/csv',
+    'text/javascript', 'application/json', 'application/javascript',
+    'application/xml', 'application/x-ndjson', 'image/svg+xml')
+
+# supported codings, in order of preference
+ENCODINGS = ('gzip', 'deflate')
+
+
+def accepted_encoding(header):
+    '''
+    Return the preferred coding ('gzip' or 'deflate') allowed by an
+    Accept-Encoding header, or None when neither is acceptable.
+    '''
+    qualities = {}
+    for item in (header or '').split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for coding in ENCODINGS:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def add_vary(headers, field='Accept-Encoding'):
+    '''Add `field` to the Vary header unless it's already covered.'''
+    values = [v.strip() for v in headers.get('Vary', '').split(',') if v.strip()]
+    if '*' in values or field.lower() in [v.lower() for v in values]:
+        return headers
+    headers['Vary'] = ', '.join(values + [field])
+    return headers
+
+
+class Compress(object):
+    '''
+    WSGI middleware that gzip/deflate compresses responses.
+
+    A response is compressed when the client accepts a supported coding,
+    its content type is in `mimetypes`, it isn't already encoded (or
+    marked ``Cache-Control: no-transform``) and its body is at least
+    `min_size` bytes. Bodies of unknown length are buffered only up to
+    `min_size`; after that each chunk is compressed and flushed as it is
+    produced, so streamed responses stay streamed.
+
+    Every response of a compressible type gets ``Vary: Accept-Encoding``,
+    compressed or not.
+    '''
+    def __init__(self, application, min_size=500, level=6, mimetypes=DEFAULT_MIMETYPES):
+        self.application = application
+        self.min_size = min_size
+        self.level = level
+        self.mimetypes = frozenset(mimetypes)
+
+    def compressible_type(self, headers):
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip().lower()
+        return mimetype in self.mimetypes
+
+    def skip(self, environ, status, headers):
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return True
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return True
+        if headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            return True
+        if 'Content-Range' in headers:
+            return True
+        return 'no-transform' in headers.get('Cache-Control', '').lower()
+
+    def compressor(self, encoding):
+        if encoding == 'gzip':
+            return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+    def __call__(self, environ, start_response):
+        captured = []
+        pending = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return pending.append
+
+        chunks = _chunks(self.application(environ, capture), pending)
+
+        # apps may defer start_response until their first chunk
+        head = []
+        if not captured:
+            for chunk in chunks:
+                head.append(chunk)
+                if captured:
+                    break
+        status, headers, exc_info = captured
+        headers = Headers(headers)
+
+        if not self.compressible_type(headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return _prepend(head, chunks)
+        add_vary(headers)
+        encoding = accepted_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None or self.skip(environ, status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return _prepend(head, chunks)
+
+        length = headers.get('Content-Length')
+        streamed = length is None
+        if not streamed and int(length) < self.min_size:
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return _prepend(head, chunks)
+
+        if streamed:
+            # buffer up to min_size to find out whether it's worth it
+            size = sum(len(chunk) for chunk in head)
+            for chunk in chunks if size < self.min_size else ():
+                head.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+            else:
+                if size < self.min_size:
+                    body = b''.join(head)
+                    headers['Content-Length'] = str(len(body))
+                    start_response(status, headers.to_wsgi_list(), exc_info)
+                    return [body]
+
+        headers.pop('Content-Length', None)
+        headers['Content-Encoding'] = encoding
+        # the compressed entity is a different representation
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            headers['ETag'] = 'W/' + etag
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return self.compress(_prepend(head, chunks), encoding, streamed)
+
+    def compress(self, chunks, encoding, flush_chunks):
+        compressor = self.compressor(encoding)
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if flush_chunks:
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            chunks.close()
+
+
+def _chunks(app_iter, pending):
+    '''Yield the app's body, including data passed to the write() callable.'''
+    try:
+        for chunk in app_iter:
+            while pending:
+                yield pending.pop(0)
+            if chunk:
+                yield chunk
+        while pending:
+            yield pending.pop(0)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def _prepend(head, chunks):
+    try:
+        for chunk in head:
+            yield chunk
+        for chunk in chunks:
+            yield chunk
+    finally:
+        chunks.close()
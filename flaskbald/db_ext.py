@@ -1,22 +1,183 @@
+import collections
+import itertools
+import json
+import threading
+import zlib
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.mutable import Mutable
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flaskbald.model import create_model
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-db = SQLAlchemy()
+
+# app config keys for read replicas
+REPLICA_URIS = 'SQLALCHEMY_REPLICA_URIS'
+REPLICA_SELECTION = 'SQLALCHEMY_REPLICA_SELECTION'
+REPLICA_ENGINE_OPTIONS = 'SQLALCHEMY_REPLICA_ENGINE_OPTIONS'
+ROUND_ROBIN = 'round_robin'
+LEAST_CONNECTIONS = 'least_connections'
+
+# session.info flags
+USE_PRIMARY = 'use_primary'
+REPLICA = 'replica'
+WRITES = 'writes'
+
+
+class ReplicaSet(object):
+    '''
+    The engines for a pool of read replicas and the policy used to pick
+    one of them: round robin or least checked-out connections.
+    '''
+    def __init__(self, uris, selection=ROUND_ROBIN, engine_options=None):
+        if selection not in (ROUND_ROBIN, LEAST_CONNECTIONS):
+            raise ValueError("Unknown replica selection: '{0}'".format(selection))
+        self.selection = selection
+        self.engines = [sa.create_engine(uri, **(engine_options or {}))
+                        for uri in uris]
+        self.in_use = dict((engine, 0) for engine in self.engines)
+        self._cycle = itertools.cycle(self.engines)
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            self._track_connections(engine)
+
+    @classmethod
+    def from_config(cls, config):
+        '''Build a ReplicaSet from the app config, or None if not configured.'''
+        uris = config.get(REPLICA_URIS)
+        if not uris:
+            return None
+        return cls(uris, config.get(REPLICA_SELECTION, ROUND_ROBIN),
+                   config.get(REPLICA_ENGINE_OPTIONS))
+
+    def _track_connections(self, engine):
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self.in_use[engine] += 1
+
+        def checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self.in_use[engine] -= 1
+
+        sa.event.listen(engine, 'checkout', checkout)
+        sa.event.listen(engine, 'checkin', checkin)
+
+    def select(self):
+        '''Pick the replica engine for a new session.'''
+        with self._lock:
+            if self.selection == LEAST_CONNECTIONS:
+                return min(self.engines, key=lambda engine: self.in_use[engine])
+            return next(self._cycle)
+
+    def dispose(self):
+        '''Dispose of every replica connection pool.'''
+        for engine in self.engines:
+            engine.dispose()
+
+
+class RoutingSession(SignallingSession):
+    '''
+    A session that sends plain SELECTs to a read replica, when the app has
+    replicas configured, and everything else to the primary.
+
+    Once the session flushes or executes any other statement, every
+    following statement of the session (i.e. the rest of the request) goes
+    to the primary so the request reads its own writes.
+
+    Sessions also note in `info['writes']` whether the current transaction
+    may have written anything, so clean sessions can skip the COMMIT.
+    '''
+    def get_bind(self, mapper=None, clause=None):
+        # locking reads (SELECT ... FOR UPDATE) must run on the primary; a
+        # lookup without a clause (e.g. to inspect the dialect) is no write
+        writes = (self._flushing or
+                  getattr(clause, '_for_update_arg', None) is not None or
+                  (clause is not None and
+                   not isinstance(clause, sa.sql.expression.SelectBase)))
+        if writes:
+            self.info[WRITES] = True
+        replicas = self.app.extensions.get('flaskbald_replicas')
+        if replicas is None or self.info.get(USE_PRIMARY):
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        if mapper is not None and mapper.local_table.info.get('bind_key'):
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        if writes:
+            self.use_primary()
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        if REPLICA not in self.info:
+            self.info[REPLICA] = replicas.select()
+        return self.info[REPLICA]
+
+    def use_primary(self):
+        '''Send every remaining statement of this session to the primary.'''
+        self.info[USE_PRIMARY] = True
+
+    def has_writes(self):
+        '''
+        True if the current transaction may have written anything or has
+        pending changes that a commit would flush.
+        '''
+        return bool(self.info.get(WRITES) or self.new or self.deleted or
+                    self.dirty)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''
+    Flask-SQLAlchemy extension using :py:class:`RoutingSession`. Read
+    replicas are configured with ``SQLALCHEMY_REPLICA_URIS`` (a list of
+    database URIs), ``SQLALCHEMY_REPLICA_SELECTION`` ('round_robin' or
+    'least_connections') and ``SQLALCHEMY_REPLICA_ENGINE_OPTIONS``.
+    '''
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        super(RoutingSQLAlchemy, self).init_app(app)
+        app.extensions['flaskbald_replicas'] = ReplicaSet.from_config(app.config)
+
+
+db = RoutingSQLAlchemy()
 Model = create_model(db)
 
 
+@sa.event.listens_for(db.session, 'after_transaction_end')
+def _reset_writes(session, transaction):
+    # only when the outermost transaction ends: releasing or rolling back
+    # a SAVEPOINT leaves the enclosing transaction's writes in place
+    if transaction.parent is None:
+        session.info.pop(WRITES, None)
+
+
 class MutationDict(Mutable, dict):
     '''
     A dictionary that automatically emits change events for SQA
     change tracking.
 
-    Lifted almost verbatim from the SQA docs.
+    Lifted almost verbatim from the SQA docs, extended to record which
+    keys changed (including keys of nested dictionaries, which are
+    tracked too) since the value was loaded. On PostgreSQL JSONB and
+    SQLite JSON columns the flush then only sends that diff via
+    `jsonb_set` / `json_set`; elsewhere the whole value is rewritten.
     '''
+    # above this many changed paths a full rewrite is sent instead
+    partial_update_limit = 32
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        for key, value in dict.items(self):
+            if isinstance(value, dict):
+                dict.__setitem__(self, key, self._adopt(key, value))
+
     @classmethod
     def coerce(cls, key, value):
         "Convert plain dictionaries to MutationDict."
+        if isinstance(value, PackedValue):
+            value = value.decode()
         if not isinstance(value, MutationDict):
             if isinstance(value, dict):
                 return MutationDict(value)
@@ -25,6 +186,59 @@ class MutationDict(Mutable, dict):
         else:
             return value
 
+    @classmethod
+    def _listen_on_attribute(cls, attribute, coerce, parent_cls):
+        super(MutationDict, cls)._listen_on_attribute(attribute, coerce,
+                                                       parent_cls)
+        key = attribute.key
+        _tracked_attributes.setdefault(parent_cls, set()).add(key)
+
+        def loaded(state, *args):
+            # values loaded from the database start with an empty diff
+            value = state.dict.get(key)
+            if isinstance(value, MutationDict):
+                value._diff = {}
+
+        sa.event.listen(parent_cls, 'load', loaded, raw=True, propagate=True)
+        sa.event.listen(parent_cls, 'refresh', loaded, raw=True, propagate=True)
+
+    def _adopt(self, key, value):
+        '''Wrap a nested dictionary so its changes are reported to us.'''
+        if not (isinstance(value, MutationDict) and
+                value.__dict__.get('_owner') in (None, (self, key))):
+            value = MutationDict(value)
+        value._owner = (self, key)
+        return value
+
+    def changed(self):
+        "Nested dictionaries report changes through their owner."
+        owner = self.__dict__.get('_owner')
+        if owner is not None:
+            owner[0].changed()
+        else:
+            Mutable.changed(self)
+
+    def _changed_path(self, path, deleted=False):
+        '''
+        Record that `path` (a tuple of keys relative to this dictionary;
+        empty for the dictionary itself) was set or deleted, and emit the
+        change event.
+        '''
+        owner = self.__dict__.get('_owner')
+        if owner is not None:
+            parent, key = owner
+            return parent._changed_path((key,) + path, deleted)
+        diff = self.__dict__.get('_diff')
+        if diff is not None:
+            if not path or len(diff) >= self.partial_update_limit:
+                self._diff = None
+            elif not any(path[:i] in diff for i in range(1, len(path))):
+                for changed in [changed for changed in diff
+                                if changed[:len(path)] == path]:
+                    del diff[changed]
+                diff[path] = not deleted
+        Mutable.changed(self)
+
     def update(self, *args, **kwargs):
         '''
         Updates the current dictionary with kargs or a passed in dict.
@@ -36,13 +250,15 @@ class MutationDict(Mutable, dict):
 
     def __setitem__(self, key, value):
         "Detect dictionary set events and emit change events."
+        if isinstance(value, dict):
+            value = self._adopt(key, value)
         dict.__setitem__(self, key, value)
-        self.changed()
+        self._changed_path((key,))
 
     def __delitem__(self, key):
         "Detect dictionary del events and emit change events."
         dict.__delitem__(self, key)
-        self.changed()
+        self._changed_path((key,), deleted=True)
 
     def __getstate__(self):
         '''Get state returns a plain dictionary for pickling purposes.'''
@@ -55,26 +271,391 @@ class MutationDict(Mutable, dict):
         '''
         self.update(state)
 
-    def pop(self, *pargs, **kargs):
+    def setdefault(self, key, default=None):
+        """
+        Wrap standard setdefault() to track the key when it is set.
+        """
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def clear(self):
+        """
+        Wrap standard clear() to trigger a full rewrite.
+        """
+        dict.clear(self)
+        self._changed_path(())
+
+    def pop(self, key, *pargs):
         """
         Wrap standard pop() to trigger self.changed()
         """
-        try:
-            result = super(MutationDict, self).pop(*pargs, **kargs)
-        except Exception:
-            raise
-        else:
-            self.changed()
-            return result
+        existed = key in self
+        result = super(MutationDict, self).pop(key, *pargs)
+        if existed:
+            self._changed_path((key,), deleted=True)
+        return result
 
-    def popitem(self, *pargs, **kargs):
+    def popitem(self):
         """
         Wrap standard popitem() to trigger self.changed()
         """
-        try:
-            result = super(MutationDict, self).popitem(*pargs, **kargs)
-        except Exception:
-            raise
-        else:
-            self.changed()
-            return result
+        key, value = super(MutationDict, self).popitem()
+        self._changed_path((key,), deleted=True)
+        return key, value
+
+    def _partial_update(self, column, dialect):
+        '''
+        Return a SQL expression applying the recorded diff to `column`, or
+        None if a full rewrite is needed.
+        '''
+        diff = self.__dict__.get('_diff')
+        if not diff or not isinstance(column.type, sa.JSON):
+            return None
+        if dialect.name == 'postgresql':
+            if not isinstance(column.type, postgresql.JSONB):
+                return None
+            return self._jsonb_set(column, diff)
+        if dialect.name == 'sqlite':
+            return self._json_set(column, diff)
+        return None
+
+    def _value_at(self, path):
+        value = self
+        for key in path:
+            value = dict.__getitem__(value, key)
+        return value
+
+    def _json_set(self, column, diff):
+        # SQLite JSON paths have no escape for quotes inside a quoted key:
+        # values with such keys are rewritten in full instead
+        if any(not isinstance(key, basestring) or '"' in key or '\\' in key
+               for path in diff for key in path):
+            return None
+        expression = column
+        for path, is_set in sorted(diff.items()):
+            json_path = '$' + ''.join('."{0}"'.format(key) for key in path)
+            if is_set:
+                expression = sa.func.json_set(expression, json_path, sa.func.json(
+                    json.dumps(self._value_at(path))))
+            else:
+                expression = sa.func.json_remove(expression, json_path)
+        return expression
+
+    def _jsonb_set(self, column, diff):
+        expression = column
+        for path, is_set in sorted(diff.items()):
+            json_path = sa.literal([unicode(key) for key in path],
+                                   type_=postgresql.ARRAY(sa.UnicodeText))
+            if is_set:
+                value = sa.cast(sa.literal(json.dumps(self._value_at(path)),
+                                           type_=sa.UnicodeText), postgresql.JSONB)
+                expression = sa.func.jsonb_set(expression, json_path, value)
+            else:
+                expression = expression.op('#-')(json_path)
+        return expression
+
+
+
+class LazyMutationDict(Mutable, collections.Mapping):
+    '''
+    Copy-on-write variant of :py:class:`MutationDict` for columns that are
+    mostly read, e.g. ``LazyMutationDict.as_mutable(sa.JSON)``.
+
+    A loaded value is a thin read-only view over the decoded dictionary;
+    nothing is copied until the first mutation, which swaps a tracked
+    MutationDict copy into the instance and applies the change to it.
+    Nested dictionaries are returned as views too. Values are mappings,
+    not dict instances: use `to_dict()` (as :py:func:`json_response`
+    does) where a real dict is needed.
+    '''
+    def __init__(self, data, root=None, path=()):
+        self._data = data
+        self._root = root
+        self._path = path
+        self._copy = None
+
+    @classmethod
+    def coerce(cls, key, value):
+        "Wrap plain dictionaries without copying them."
+        if isinstance(value, (LazyMutationDict, MutationDict)):
+            return value
+        if isinstance(value, (dict, PackedValue)):
+            return cls(value)
+        # this call will raise ValueError
+        return Mutable.coerce(key, value)
+
+    @classmethod
+    def _listen_on_attribute(cls, attribute, coerce, parent_cls):
+        super(LazyMutationDict, cls)._listen_on_attribute(attribute, coerce,
+                                                           parent_cls)
+        key = attribute.key
+        _tracked_attributes.setdefault(parent_cls, set()).add(key)
+
+        def set_(state, value, oldvalue, initiator):
+            # assigned values are written in full, so store a real copy
+            if isinstance(value, LazyMutationDict):
+                value._parents.pop(state.obj(), None)
+                value = MutationDict(value._target())
+                value._parents[state.obj()] = key
+            return value
+
+        sa.event.listen(attribute, 'set', set_, raw=True, retval=True,
+                        propagate=True)
+
+    def _target(self):
+        root = self._root or self
+        if root._copy is None:
+            if type(self._data) is PackedValue:
+                # decode a lazily loaded PackedDict column on first access
+                self._data = self._data.decode()
+            return self._data
+        return root._copy._value_at(self._path)
+
+    def _writable(self):
+        '''
+        Swap a tracked MutationDict copy into the parent instances (once)
+        and return the dictionary this view maps to inside it.
+        '''
+        root = self._root or self
+        if root._copy is None:
+            tracked = MutationDict(root._target())
+            tracked._diff = {}
+            for parent, key in root._parents.items():
+                orm.attributes.instance_state(parent).dict[key] = tracked
+                tracked._parents[parent] = key
+            root._copy = tracked
+        return root._copy._value_at(self._path)
+
+    def __getitem__(self, key):
+        value = self._target()[key]
+        if type(value) is dict:
+            return LazyMutationDict(value, self._root or self,
+                                    self._path + (key,))
+        return value
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMutationDict):
+            other = other._target()
+        return self._target() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._target())
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        del self._writable()[key]
+
+    def update(self, *args, **kwargs):
+        self._writable().update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        return self._writable().setdefault(key, default)
+
+    def pop(self, key, *pargs):
+        return self._writable().pop(key, *pargs)
+
+    def popitem(self):
+        return self._writable().popitem()
+
+    def clear(self):
+        self._writable().clear()
+
+    def copy(self):
+        '''Return a shallow plain dictionary copy.'''
+        return dict(self._target())
+
+    def to_dict(self):
+        '''Return the underlying dictionary (without copying it).'''
+        return self._target()
+
+    def __getstate__(self):
+        '''Get state returns a plain dictionary for pickling purposes.'''
+        return dict(self._target())
+
+    def __setstate__(self, state):
+        '''Set state re-constitutes an unmodified view over the dictionary.'''
+        self.__init__(state)
+
+
+# PackedDict header byte: low bits select the encoding, high bit = zlib
+PACKED_JSON = 0x00
+PACKED_MSGPACK = 0x01
+PACKED_COMPRESSED = 0x80
+
+
+def pack_value(value, encoding=None, compress_threshold=1024, compress_level=6):
+    '''
+    Encode a value into the PackedDict binary format: a header byte
+    followed by msgpack (when installed) or compact UTF-8 JSON, zlib
+    compressed when the payload is larger than `compress_threshold` bytes.
+    '''
+    if encoding is None:
+        encoding = 'msgpack' if msgpack is not None else 'json'
+    if encoding == 'msgpack':
+        header = PACKED_MSGPACK
+        payload = msgpack.packb(value, use_bin_type=True)
+    else:
+        header = PACKED_JSON
+        payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if compress_threshold is not None and len(payload) > compress_threshold:
+        compressed = zlib.compress(payload, compress_level)
+        if len(compressed) < len(payload):
+            header |= PACKED_COMPRESSED
+            payload = compressed
+    return chr(header) + payload
+
+
+def unpack_value(data):
+    '''Decode a value stored by :py:func:`pack_value`.'''
+    header, payload = ord(data[0]), data[1:]
+    if header & PACKED_COMPRESSED:
+        payload = zlib.decompress(payload)
+    if header & ~PACKED_COMPRESSED == PACKED_MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack is required to decode this value")
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload.decode('utf-8'))
+
+
+class PackedValue(object):
+    '''
+    A PackedDict column value that hasn't been decoded yet. Decoding
+    happens (once) on the first call to :py:meth:`decode`.
+    '''
+    __slots__ = ('raw', '_value')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._value = self
+
+    def decode(self):
+        if self._value is self:
+            self._value = unpack_value(self.raw)
+        return self._value
+
+    def __getstate__(self):
+        return self.raw
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+
+class PackedDict(sa.types.TypeDecorator):
+    '''
+    Stores dictionaries in a compact binary column: msgpack if installed,
+    compact JSON otherwise, zlib compressed above `compress_threshold`
+    bytes. Values written either way can be read back as long as msgpack
+    is available for msgpack-encoded ones.
+
+    With `lazy=True` loaded values are :py:class:`PackedValue` objects
+    that are only decoded on first access; pair it with
+    ``LazyMutationDict.as_mutable(PackedDict(lazy=True))``.
+    ``MutationDict.as_mutable(PackedDict())`` works as well.
+    '''
+    impl = sa.LargeBinary
+
+    def __init__(self, encoding=None, compress_threshold=1024,
+                 compress_level=6, lazy=False, *pargs, **kargs):
+        super(PackedDict, self).__init__(*pargs, **kargs)
+        self.encoding = encoding
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.lazy = lazy
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, PackedValue):
+            if value._value is value:
+                return value.raw
+            value = value.decode()
+        if isinstance(value, LazyMutationDict):
+            value = value.to_dict()
+        return pack_value(value, self.encoding, self.compress_threshold,
+                          self.compress_level)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        if self.lazy:
+            return PackedValue(value)
+        return unpack_value(value)
+
+# mapped classes -> attribute keys using MutationDict
+_tracked_attributes = {}
+
+
+def _tracked_keys(cls):
+    keys = set()
+    for parent_cls, parent_keys in _tracked_attributes.items():
+        if issubclass(cls, parent_cls):
+            keys.update(parent_keys)
+    return keys
+
+
+@sa.event.listens_for(orm.Session, 'before_flush')
+def _partial_json_updates(session, flush_context, instances):
+    '''
+    Swap in-place modified MutationDict values for expressions that only
+    apply their diff, and remember every flushed MutationDict so its diff
+    can be reset after the flush.
+    '''
+    if not _tracked_attributes:
+        return
+    flushed = []
+    for obj in list(session.new) + list(session.dirty):
+        state = orm.attributes.instance_state(obj)
+        for key in _tracked_keys(type(obj)):
+            value = state.dict.get(key)
+            if not isinstance(value, MutationDict):
+                continue
+            expression = None
+            # only in-place modifications of persisted values qualify, not
+            # reassigned attributes
+            if state.key is not None and \
+                    state.committed_state.get(key, None) is orm.attributes.NO_VALUE:
+                mapper = state.mapper
+                column = mapper.get_property(key).columns[0]
+                dialect = session.get_bind(mapper=mapper).dialect
+                expression = value._partial_update(column, dialect)
+            if expression is not None:
+                state.dict[key] = expression
+            flushed.append((obj, key, value, expression is not None))
+    if flushed:
+        session.info['mutation_dicts_flushed'] = flushed
+
+
+@sa.event.listens_for(orm.Session, 'after_soft_rollback')
+def _discard_json_diffs(session, previous_transaction):
+    # a failed flush never reaches after_flush_postexec: forget its values
+    # so the next flush doesn't mark them as committed
+    session.info.pop('mutation_dicts_flushed', None)
+
+
+@sa.event.listens_for(orm.Session, 'after_flush_postexec')
+def _reset_json_diffs(session, flush_context):
+    for obj, key, value, replaced in session.info.pop('mutation_dicts_flushed', ()):
+        if replaced:
+            # put back the value the SQL expression stood in for, instead
+            # of leaving the attribute expired
+            orm.attributes.set_committed_value(obj, key, value)
+            value._parents[obj] = key
+        value._diff = {}
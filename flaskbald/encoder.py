@@ -0,0 +1,166 @@
+# encoding: utf-8
+import datetime
+import decimal
+import json
+import uuid
+import sqlalchemy as sa
+from db_ext import LazyMutationDict, MutationDict
+
+# number of bytes gathered before a streamed chunk is yielded
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# type -> function returning a JSON-encodable replacement
+encoders = {}
+# lookup cache for subclasses of the registered types
+_resolved = {}
+
+
+def register_encoder(type_, encoder=None):
+    '''
+    Register `encoder(obj)` to convert instances of `type_` (and of its
+    subclasses, unless they have their own encoder) into something JSON
+    encodable. Works as a decorator when `encoder` is omitted:
+
+        @register_encoder(Money)
+        def encode_money(money):
+            return {'amount': str(money.amount), 'currency': money.currency}
+    '''
+    def register(encoder):
+        encoders[type_] = encoder
+        _resolved.clear()
+        return encoder
+
+    if encoder is None:
+        return register
+    return register(encoder)
+
+
+def encode_model(obj):
+    '''Column attributes of a mapped instance, skipping unloaded deferred ones.'''
+    state = sa.inspect(obj)
+    unloaded = state.unloaded
+    return dict((attr.key, getattr(obj, attr.key))
+                for attr in state.mapper.column_attrs
+                if not (attr.deferred and attr.key in unloaded))
+
+
+def _to_dict(obj):
+    return obj.to_dict()
+
+
+def _resolve(cls):
+    for klass in cls.__mro__:
+        if klass in encoders:
+            return encoders[klass]
+    if hasattr(cls, 'to_dict'):
+        return _to_dict
+    if hasattr(cls, '__mapper__'):
+        return encode_model
+    return None
+
+
+def json_default(obj):
+    '''
+    Fallback for objects the JSON encoder can't encode. Dispatches on the
+    exact type first, then on the registered base classes, then encodes
+    anything with a `to_dict()` method (such as the records from
+    `Model.rows()`) as that dictionary and mapped Model instances as their
+    column values.
+    '''
+    cls = type(obj)
+    encoder = encoders.get(cls) or _resolved.get(cls)
+    if encoder is None:
+        encoder = _resolved[cls] = _resolve(cls)
+        if encoder is None:
+            del _resolved[cls]
+            raise TypeError("{0!r} is not JSON serializable".format(obj))
+    return encoder(obj)
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+register_encoder(datetime.datetime, _isoformat)
+register_encoder(datetime.date, _isoformat)
+register_encoder(datetime.time, _isoformat)
+register_encoder(datetime.timedelta, lambda value: value.total_seconds())
+# strings keep every digit; register float instead for JSON numbers
+register_encoder(decimal.Decimal, str)
+register_encoder(uuid.UUID, str)
+register_encoder(set, list)
+register_encoder(frozenset, list)
+register_encoder(MutationDict, dict)
+register_encoder(LazyMutationDict, _to_dict)
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=json_default)
+
+
+def _load_backends():
+    backends = [('json', _stdlib_dumps)]
+    try:
+        import simplejson
+    except ImportError:
+        pass
+    else:
+        backends.append(('simplejson', lambda obj: simplejson.dumps(
+            obj, default=json_default, use_decimal=False)))
+    try:
+        import ujson
+        ujson.dumps([], default=str)
+    except (ImportError, TypeError):
+        pass
+    else:
+        backends.append(('ujson', lambda obj: ujson.dumps(
+            obj, default=json_default)))
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        backends.append(('orjson', lambda obj: orjson.dumps(
+            obj, default=json_default,
+            option=orjson.OPT_NON_STR_KEYS).decode('utf-8')))
+    return dict(backends), backends[-1][0]
+
+backends, backend = _load_backends()
+dumps = backends[backend]
+
+
+def use_backend(name):
+    '''
+    Select the JSON encoder used by `dumps`: 'json' (stdlib) or one of the
+    installed C encoders ('simplejson', 'ujson', 'orjson'). The fastest
+    installed one is used by default.
+    '''
+    global backend, dumps
+    if name not in backends:
+        raise ValueError("JSON backend '{0}' isn't installed".format(name))
+    backend, dumps = name, backends[name]
+    return dumps
+
+
+def iter_envelope(items, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Yield the JSON ``{"status": "success", "data": [...]}`` envelope for an
+    iterable of items, encoding one item at a time and yielding chunks of
+    about `chunk_size` bytes, so memory use doesn't grow with the number
+    of items.
+    '''
+    buffer = ['{"status": "success", "data": [']
+    size = 0
+    separator = ''
+    for item in items:
+        encoded = dumps(item)
+        buffer.append(separator)
+        buffer.append(encoded)
+        separator = ', '
+        size += len(encoded) + 2
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(']}')
+    yield ''.join(buffer)
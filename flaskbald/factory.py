@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 # encoding: utf-8
-from flask import Flask, render_template, request
+from flask import Flask, got_request_exception, render_template
 from db_ext import db
-from celery_ext import celery
-from response import APINotFound, api_action
-from log import default_debug_log
-from flask.ext.cors import CORS, cross_origin
+from response import APINotFound, api_action, register_template_functions
+from log import default_debug_log, SQLProfiler
+from fragments import setup_fragment_cache
+from transaction import commit_request, end_request, request_failed
+from contextlib import contextmanager
+import gc
+import logging
 import os
+import sys
+import tempfile
+import time
 import jinja2
-from flask_errormail import mail_on_500
-from flask.ext.mail import Mail
-from flask_sslify import SSLify
+
+log = logging.getLogger(__name__)
 
 
 ALLOWED_HOSTS = 'ALLOWED_HOSTS'
@@ -28,6 +33,25 @@ def load_config(app, config_file=None, env='development'):
     return app
 
 
+class AtomicBytecodeCache(jinja2.FileSystemBytecodeCache):
+    '''
+    On-disk Jinja bytecode cache that can be shared by several worker
+    processes: files are written to a temporary name and renamed into
+    place, so a worker never reads a half-written file.
+    '''
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        # a unique name per write: threads of one process may race too
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                bucket.write_bytecode(cache_file)
+            os.rename(temp, filename)
+        except Exception:
+            os.remove(temp)
+            raise
+
+
 def setup_templates(app, custom_template_paths=[]):
     base_template_dir = os.path.join(
         os.path.abspath(os.path.dirname(__file__)),
@@ -43,6 +67,22 @@ def setup_templates(app, custom_template_paths=[]):
             template_paths.append(jinja2.FileSystemLoader(cp))
 
     app.jinja_loader = jinja2.ChoiceLoader(template_paths)
+
+    # set up the environment once, before any template is loaded: templates
+    # keep a copy of the globals they were loaded with
+    env = app.jinja_env
+    register_template_functions(app)
+    setup_fragment_cache(app)
+    # only stat template files for changes while debugging
+    auto_reload = app.config.get('TEMPLATES_AUTO_RELOAD')
+    if auto_reload is None:
+        auto_reload = bool(app.config.get('DEBUG'))
+    env.auto_reload = auto_reload
+    cache_dir = app.config.get('TEMPLATE_BYTECODE_CACHE_DIR')
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        env.bytecode_cache = AtomicBytecodeCache(cache_dir)
     return app
 
 
@@ -57,6 +97,11 @@ def setup_debug_log(app):
     return app
 
 
+def setup_sql_profiler(app):
+    SQLProfiler(app, repeat_threshold=app.config.get('SQL_PROFILE_REPEAT_THRESHOLD', 5))
+    return app
+
+
 def error_endpoints(app, custom_error_endpoints=False):
     if custom_error_endpoints is True:
         return app
@@ -72,6 +117,64 @@ def error_endpoints(app, custom_error_endpoints=False):
     return app
 
 
+class HostGate(object):
+    '''
+    WSGI middleware that answers 404 for requests whose Host header isn't
+    allowed, before they reach Flask.
+
+    Patterns are compiled once into a set of exact hosts and a set of
+    domain suffixes:
+
+    * ``example.com`` matches that host on any port,
+    * ``example.com:8080`` matches only that port,
+    * ``*.example.com`` matches any subdomain of example.com,
+    * ``.example.com`` matches example.com and any subdomain.
+    '''
+    def __init__(self, application, allowed_hosts, debug=False):
+        self.application = application
+        self.debug = debug
+        if isinstance(allowed_hosts, basestring):
+            allowed_hosts = allowed_hosts.split(',')
+        self.exact = set()
+        self.suffixes = set()
+        for pattern in allowed_hosts:
+            pattern = pattern.strip().lower().rstrip('.')
+            if pattern.startswith('*.'):
+                self.suffixes.add(pattern[1:])
+            elif pattern.startswith('.'):
+                self.suffixes.add(pattern)
+                self.exact.add(pattern[1:])
+            elif pattern:
+                self.exact.add(pattern)
+
+    def allowed(self, host):
+        host = host.lower()
+        if host in self.exact:
+            return True
+        # drop the port unless it's part of an IPv6 literal
+        if ':' in host and not host.endswith(']'):
+            host = host.rsplit(':', 1)[0]
+        host = host.rstrip('.')
+        if host in self.exact:
+            return True
+        index = host.find('.')
+        while index != -1:
+            if host[index:] in self.suffixes:
+                return True
+            index = host.find('.', index + 1)
+        return False
+
+    def __call__(self, environ, start_response):
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        if self.allowed(host):
+            return self.application(environ, start_response)
+        if self.debug:
+            response = APINotFound(message="Invalid host: '{0}'".format(host))
+        else:
+            response = APINotFound()
+        return response(environ, start_response)
+
+
 def before_handler(app, custom_handler, custom_handler_args, custom_handler_kargs):
 
     if custom_handler:
@@ -81,14 +184,10 @@ def before_handler(app, custom_handler, custom_handler_args, custom_handler_karg
 
         return app
 
-    @app.before_request
-    def before_request():
-        origin_request = request.from_values()
-        if app.config[ALLOWED_HOSTS] != ALL_HOSTS and origin_request.host not in app.config[ALLOWED_HOSTS]:
-            if app.config.get('DEBUG', app.config.get('debug')):
-                return APINotFound(message="Invalid host: '{0}'".format(origin_request.host))
-            else:
-                return APINotFound()
+    allowed_hosts = app.config.get(ALLOWED_HOSTS, ALL_HOSTS)
+    if allowed_hosts != ALL_HOSTS:
+        app.wsgi_app = HostGate(app.wsgi_app, allowed_hosts,
+                                debug=app.config.get('DEBUG', app.config.get('debug')))
 
     return app
 
@@ -109,18 +208,37 @@ def after_handler(app, custom_handler, custom_handler_args, custom_handler_kargs
     @app.after_request
     def after_request(response):
         if db_enabled:
-            # Commit the session
-            db.session.commit()
-
-            # Close the session
-            db.session.close()
-
-            # Remove the session
-            db.session.remove()
+            # Commit the session according to the view's transaction policy
+            response = commit_request(response)
 
         # Return the response object
         return response
 
+    if db_enabled:
+        # Don't commit requests that raised, even though their 500 response
+        # goes through after_request
+        got_request_exception.connect(request_failed, app)
+        # Roll back anything uncommitted, close and remove the session, even
+        # when the handler raised
+        app.teardown_request(end_request)
+
+    return app
+
+
+def setup_compression(app):
+    from compress import Compress, DEFAULT_MIMETYPES
+    app.wsgi_app = Compress(
+        app.wsgi_app,
+        min_size=app.config.get('COMPRESS_MIN_SIZE', 500),
+        level=app.config.get('COMPRESS_LEVEL', 6),
+        mimetypes=app.config.get('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES))
+    return app
+
+
+def setup_metrics(app):
+    from metrics import Metrics
+    Metrics(app, path=app.config.get('METRICS_PATH', '/metrics'),
+            flush_interval=app.config.get('METRICS_FLUSH_INTERVAL', 1.0))
     return app
 
 
@@ -152,13 +270,108 @@ def setup_routes(app):
     return app
 
 
+def precompile_templates(app):
+    '''
+    Compile every template reachable from the app's loaders (the
+    ChoiceLoader built by setup_templates plus blueprint loaders) into the
+    Jinja environment cache, growing the cache to hold them all.
+    '''
+    env = app.jinja_env
+    names = env.list_templates()
+    capacity = getattr(env.cache, 'capacity', None)
+    if capacity is not None and capacity < len(names):
+        env.cache = jinja2.utils.LRUCache(len(names))
+    compiled = 0
+    for name in names:
+        try:
+            env.get_template(name)
+        except (jinja2.TemplateError, UnicodeDecodeError) as error:
+            log.warning("Could not precompile template '{0}': {1}".format(name, error))
+        else:
+            compiled += 1
+    return compiled
+
+
+def dispose_engines(app):
+    '''
+    Dispose of the connection pools of every database engine (default,
+    binds and read replicas) so forked workers open their own connections.
+    '''
+    for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+        db.get_engine(app, bind=bind).dispose()
+    replicas = app.extensions.get('flaskbald_replicas')
+    if replicas is not None:
+        replicas.dispose()
+    return app
+
+
+def warmup(app, db_enabled=True):
+    '''
+    Do the work each prefork worker would otherwise repeat lazily on its
+    first requests, once in the master process before forking:
+
+    * import the modules in ``WARMUP_MODULES``,
+    * build the routing tables,
+    * precompile every template,
+    * dispose of database engine pools so children reconnect after fork,
+    * collect garbage and freeze the surviving objects (``gc.freeze()`` on
+      Python 3.7+) so they stay shared copy-on-write with the workers.
+    '''
+    for module in app.config.get('WARMUP_MODULES', []):
+        __import__(module)
+
+    app.url_map.update()
+    with app.app_context():
+        precompile_templates(app)
+
+    if db_enabled:
+        dispose_engines(app)
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return app
+
+
+class StartupReport(object):
+    '''
+    Records the wall time of each create_app() phase, and the import time
+    of each flaskbald submodule.
+    '''
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        yield
+        self.phases.append((name, time.time() - start))
+
+    def imports(self):
+        package = sys.modules[__name__.rsplit('.', 1)[0]]
+        return sorted(getattr(package, 'import_times', {}).items(),
+                      key=lambda item: item[1], reverse=True)
+
+    def show(self):
+        print '{:40s} {:>10s}'.format('Startup phase', 'ms')
+        for name, seconds in self.phases:
+            print '{:40s} {:10.1f}'.format(name, seconds * 1000)
+        print '{:40s} {:10.1f}'.format(
+            'total', sum(seconds for name, seconds in self.phases) * 1000)
+        print '{:40s} {:>10s}'.format('Module import', 'ms')
+        for name, seconds in self.imports():
+            print '{:40s} {:10.1f}'.format(name, seconds * 1000)
+
+
 def create_app(config_file, blueprints=[], custom_error_endpoints=False,
                custom_template_paths=[], custom_before_handler=None,
                custom_before_handler_args=[], custom_before_handler_kargs={},
                custom_after_handler=None, custom_after_handler_args=[],
                custom_after_handler_kargs={}, template_folder=None,
                cors=True, ssl_only=True, db_enabled=True, static_url_path=None,
-               static_folder=None):
+               static_folder=None, profile_sql=False, startup_report=False,
+               warmup_app=False, compress=False, metrics=False,
+               precompile=False):
 
     if config_file is None:
         raise(Exception("Hey, 'config_files' cannot be 'None'!"))
@@ -171,35 +384,71 @@ def create_app(config_file, blueprints=[], custom_error_endpoints=False,
     if static_folder:
         flask_init_options['static_folder'] = static_folder
 
-    app = Flask(__name__, **flask_init_options)
-    app = load_config(app, config_file)
+    report = StartupReport()
+
+    with report.phase('config'):
+        app = Flask(__name__, **flask_init_options)
+        app = load_config(app, config_file)
 
     if ssl_only is True and app.config.get("DEBUG") is False:
-        print 'SSL this shit!'
-        print ''
-        sslify = SSLify(app)
-
-    app = setup_templates(app, custom_template_paths)
-    app = setup_debug_log(app)
-    app = register_blue_prints(app, blueprints)
-    app = error_endpoints(app, custom_error_endpoints)
-    app = before_handler(app, custom_before_handler, custom_before_handler_args, custom_before_handler_kargs)
-    app = after_handler(app, custom_after_handler, custom_after_handler_args, custom_after_handler_kargs, db_enabled)
+        with report.phase('ssl'):
+            from flask_sslify import SSLify
+            print 'SSL this shit!'
+            print ''
+            sslify = SSLify(app)
+
+    with report.phase('templates'):
+        app = setup_templates(app, custom_template_paths)
+    with report.phase('logging'):
+        app = setup_debug_log(app)
+        if profile_sql or app.config.get('SQL_PROFILE'):
+            app = setup_sql_profiler(app)
+    with report.phase('blueprints'):
+        app = register_blue_prints(app, blueprints)
+    with report.phase('handlers'):
+        app = error_endpoints(app, custom_error_endpoints)
+        app = before_handler(app, custom_before_handler, custom_before_handler_args, custom_before_handler_kargs)
+        app = after_handler(app, custom_after_handler, custom_after_handler_args, custom_after_handler_kargs, db_enabled)
+    if compress or app.config.get('COMPRESS'):
+        with report.phase('compression'):
+            app = setup_compression(app)
     if db_enabled:
-        app = init_db(app)
-    app = setup_routes(app)
+        with report.phase('db init'):
+            app = init_db(app)
+    if metrics or app.config.get('METRICS'):
+        with report.phase('metrics'):
+            app = setup_metrics(app)
+    with report.phase('routes'):
+        app = setup_routes(app)
 
     if cors is True:
-        cors = CORS(app)
-        app.config['CORS_HEADERS'] = 'Content-Type'
+        with report.phase('cors'):
+            from flask.ext.cors import CORS
+            cors = CORS(app)
+            app.config['CORS_HEADERS'] = 'Content-Type'
 
     if app.config.get('DEBUG') is False:
-        mail = Mail(app)
-        mail_on_500(app, app.config.get('ADMINS'))
+        with report.phase('mail'):
+            from flask_errormail import mail_on_500
+            from flask.ext.mail import Mail
+            mail = Mail(app)
+            mail_on_500(app, app.config.get('ADMINS'))
+
+    if warmup_app or app.config.get('WARMUP'):
+        with report.phase('warmup'):
+            app = warmup(app, db_enabled)
+    elif precompile or app.config.get('TEMPLATES_PRECOMPILE'):
+        with report.phase('precompile'):
+            precompile_templates(app)
+
+    app.extensions['flaskbald_startup'] = report
+    if startup_report:
+        report.show()
 
     return app
 
 
 def create_celery_app(app):
+    from celery_ext import celery
     celery.init_app(app)
     return celery
@@ -0,0 +1,99 @@
+# encoding: utf-8
+import logging
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+
+class FragmentCacheExtension(Extension):
+    '''
+    Jinja extension adding a fragment cache tag:
+
+        {% cache 'sidebar:' ~ auth_id(), 300, ['sidebar'] %}
+            ... expensive markup ...
+        {% endcache %}
+
+    The arguments are the key, an optional time-to-live in seconds and an
+    optional list of tags for :py:func:`invalidate_fragments`. Rendered
+    fragments are stored in `environment.fragment_cache`, an in-process
+    :py:class:`LRUCache` unless replaced by any object with the same
+    `get`, `set` and `invalidate_tag` methods (e.g. a shared cache).
+
+    The hit rate is logged every `environment.fragment_cache_log_every`
+    lookups.
+    '''
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=LRUCache(max_entries=1000),
+                           fragment_cache_log_every=1000)
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        for default in (None, ()):
+            if parser.stream.skip_if('comma'):
+                args.append(parser.parse_expression())
+            else:
+                args.append(nodes.Const(default))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args),
+                               [], [], body).set_lineno(lineno)
+
+    def _cache(self, key, ttl, tags, caller):
+        cache = self.environment.fragment_cache
+        key = u'fragment:{0}'.format(key)
+        value = cache.get(key)
+        if value is not None:
+            self.hits += 1
+            self._log_stats()
+            return Markup(value)
+        self.misses += 1
+        self._log_stats()
+        value = caller()
+        cache.set(key, value, ttl=ttl, tags=tags)
+        return value
+
+    def _log_stats(self):
+        lookups = self.hits + self.misses
+        every = self.environment.fragment_cache_log_every
+        if every and lookups % every == 0:
+            log.info('Fragment cache: {0} hits, {1} misses ({2:.1f}% hit rate)'.format(
+                self.hits, self.misses, 100.0 * self.hits / lookups))
+
+
+def auth_id():
+    '''JWT subject of the logged-in user, for per-user fragment keys.'''
+    from auth import get_auth_id
+    return get_auth_id()
+
+
+def setup_fragment_cache(app):
+    '''Install the {% cache %} tag in the app's Jinja environment.'''
+    env = app.jinja_env
+    env.add_extension(FragmentCacheExtension)
+    backend = app.config.get('FRAGMENT_CACHE_BACKEND')
+    env.fragment_cache = backend or LRUCache(
+        max_entries=app.config.get('FRAGMENT_CACHE_MAX_ENTRIES', 1000))
+    env.fragment_cache_log_every = app.config.get('FRAGMENT_CACHE_LOG_EVERY', 1000)
+    env.globals.setdefault('auth_id', auth_id)
+    return app
+
+
+def invalidate_fragments(*tags):
+    '''
+    Drop the cached fragments stored with any of `tags`, e.g. from a
+    model's save(); drop every fragment when called without tags.
+    '''
+    cache = current_app.jinja_env.fragment_cache
+    if not tags:
+        cache.clear()
+    for tag in tags:
+        cache.invalidate_tag(tag)
@@ -2,7 +2,12 @@
 # encoding: utf-8
 import logging
 import logging.handlers
+import re
+import time
 from textwrap import TextWrapper
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 log = logging.getLogger(__name__)
 
 
@@ -96,3 +101,143 @@ class LogPoint(object):
         resp = self.application(environ, start_response)
         log.debug(self.log.format(' {0} '.format(self.end_message)))
         return resp
+
+
+# patterns used to reduce a SQL statement to its fingerprint
+_sql_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_sql_placeholder = re.compile(r"%\(\w+\)s|%s|:\w+|\?")
+_sql_in_list = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+_sql_whitespace = re.compile(r"\s+")
+
+
+def sql_fingerprint(statement):
+    '''
+    Normalize a SQL statement so that executions differing only in their
+    parameters or literal values share the same fingerprint.
+    '''
+    statement = _sql_literal.sub('?', statement)
+    statement = _sql_placeholder.sub('?', statement)
+    statement = _sql_in_list.sub('IN (?+)', statement)
+    return _sql_whitespace.sub(' ', statement).strip()
+
+
+# functions called as hook(cursor, statement, parameters, executemany,
+# duration) after each SQL statement executed within an app context
+statement_hooks = []
+_listening = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('statement_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('statement_start')
+    if not starts:
+        return
+    duration = time.time() - starts.pop()
+    if has_app_context():
+        for hook in statement_hooks:
+            hook(cursor, statement, parameters, executemany, duration)
+
+
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute: drop its start
+    # so the following statements are paired with their own
+    conn = exception_context.connection
+    if conn is None or exception_context.statement is None:
+        return
+    starts = conn.info.get('statement_start')
+    if starts:
+        starts.pop()
+
+
+def add_statement_hook(hook):
+    '''
+    Call `hook` with the duration of every SQL statement executed within
+    an app context. A single pair of engine listeners, installed on first
+    use, times the statements for all hooks.
+    '''
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening = True
+    if hook not in statement_hooks:
+        statement_hooks.append(hook)
+
+
+def _profile_statement(cursor, statement, parameters, executemany, duration):
+    if getattr(g, 'sql_profile', None) is None:
+        return
+    params = parameters[0] if executemany and parameters else parameters
+    g.sql_profile.append({
+        'fingerprint': sql_fingerprint(statement),
+        'params': len(params or ()),
+        'executemany': executemany,
+        'duration': duration,
+        'rows': cursor.rowcount,
+    })
+
+
+class SQLProfiler(object):
+    '''
+    Per-request SQL profiler.
+
+    Records the fingerprint, parameter count, duration and row count of
+    every statement executed while handling a request, then adds a summary
+    header to the response and logs a summary line. Fingerprints executed
+    at least `repeat_threshold` times within one request are logged as
+    possible N+1 query patterns.
+    '''
+    def __init__(self, app=None, repeat_threshold=5, header='X-SQL-Profile'):
+        self.repeat_threshold = repeat_threshold
+        self.header = header
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        add_statement_hook(_profile_statement)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.extensions['flaskbald_sql_profiler'] = self
+
+    def start(self):
+        g.sql_profile = []
+
+    def summary(self, statements):
+        '''
+        Summarize a list of recorded statements: count, total time in ms
+        and the fingerprints repeated at least `repeat_threshold` times.
+        '''
+        counts = {}
+        for statement in statements:
+            fingerprint = statement['fingerprint']
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+        repeated = dict((fingerprint, count) for fingerprint, count in
+                        counts.items() if count >= self.repeat_threshold)
+        return {
+            'queries': len(statements),
+            'time_ms': sum(s['duration'] for s in statements) * 1000,
+            'rows': sum(max(s['rows'], 0) for s in statements),
+            'repeated': repeated,
+        }
+
+    def finish(self, response):
+        statements = getattr(g, 'sql_profile', None)
+        if statements is None:
+            return response
+        g.sql_profile = None
+        summary = self.summary(statements)
+        response.headers[self.header] = (
+            'queries={queries}; time={time_ms:.1f}ms; rows={rows}; '
+            'repeated={0}'.format(len(summary['repeated']), **summary))
+        log.info('SQL {0} {1}: {queries} queries, {time_ms:.1f}ms, '
+                 '{rows} rows'.format(request.method, request.path, **summary))
+        for fingerprint, count in summary['repeated'].items():
+            log.warning('Possible N+1 in {0} {1}: {2} x {3}'.format(
+                request.method, request.path, count, fingerprint))
+        return response
@@ -0,0 +1,326 @@
+# encoding: utf-8
+import errno
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_app_context, request, Response
+from log import add_statement_hook
+
+
+# request latency histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# time spent in each part of a request, accumulated per endpoint
+TIMINGS = ('sql', 'template', 'json')
+
+# snapshot file holding the summed values of worker processes that exited
+ARCHIVE = 'metrics-archive.json'
+
+HELP = {
+    'flaskbald_requests_total': ('counter', 'Requests handled, by endpoint, method and status class.'),
+    'flaskbald_request_duration_seconds': ('histogram', 'Request latency by endpoint.'),
+    'flaskbald_sql_queries_total': ('counter', 'SQL statements executed, by endpoint.'),
+    'flaskbald_sql_seconds_total': ('counter', 'Time spent executing SQL, by endpoint.'),
+    'flaskbald_template_seconds_total': ('counter', 'Time spent rendering templates, by endpoint.'),
+    'flaskbald_json_seconds_total': ('counter', 'Time spent encoding JSON responses, by endpoint.'),
+}
+
+
+@contextmanager
+def timed(kind):
+    '''
+    Add the time spent in the block to the current request's `kind`
+    timing ('sql', 'template' or 'json') when metrics are enabled.
+    '''
+    timings = getattr(g, 'metrics_timings', None) if has_app_context() else None
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[kind] = timings.get(kind, 0.0) + time.time() - start
+
+
+def _time_statement(cursor, statement, parameters, executemany, duration):
+    timings = getattr(g, 'metrics_timings', None)
+    if timings is None:
+        return
+    timings['sql'] = timings.get('sql', 0.0) + duration
+    timings['queries'] = timings.get('queries', 0) + 1
+
+
+def _process_start(pid):
+    '''
+    Start time of process `pid` in clock ticks since boot, from /proc
+    (Linux), or None when it isn't running or /proc isn't available.
+    '''
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+    except IOError:
+        return None
+    # field 22; the command name (field 2) may contain spaces
+    return stat.rpartition(')')[2].split()[19]
+
+
+def _alive(pid, started):
+    '''
+    True if the process that wrote a file as `pid` started at `started`
+    is still running. Without /proc a reused pid counts as alive.
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        if error.errno == errno.ESRCH:
+            return False
+    start = _process_start(pid)
+    return start is None or start == started
+
+
+def _snapshot(buckets, counters, histograms):
+    return {
+        'buckets': list(buckets),
+        'counters': [[name, labels, value] for (name, labels), value
+                     in counters.items()],
+        'histograms': [[name, labels] + [list(h[0]), h[1], h[2]]
+                       for (name, labels), h in histograms.items()],
+    }
+
+
+def _labels(labels):
+    return ','.join('{0}="{1}"'.format(
+        name, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+class Metrics(object):
+    '''
+    Per-endpoint request metrics in Prometheus text format.
+
+    Counts requests by endpoint, method and status class, records a latency
+    histogram per endpoint and accumulates the time spent in SQL, template
+    rendering and JSON encoding. Values are kept in plain dictionaries
+    behind a single lock and exposed on `path`.
+
+    With `store_dir` (``METRICS_DIR``) each worker process also dumps its
+    values to a file in that directory, at most every `flush_interval`
+    seconds, and the exposition endpoint sums the files of all workers, so
+    the numbers cover every worker of a preforking server. The files of
+    exited workers are folded into one archive file when collecting.
+    '''
+    def __init__(self, app=None, path='/metrics', store_dir=None,
+                 buckets=DEFAULT_BUCKETS, flush_interval=1.0):
+        self.path = path
+        self.store_dir = store_dir
+        self.buckets = tuple(sorted(buckets))
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # tells this process's file apart from one of an earlier process
+        # with the same pid
+        self.started = _process_start(self.pid) or '{0:.0f}'.format(time.time() * 1000)
+        self.counters = {}
+        self.histograms = {}
+        self.flushed = 0
+
+    def init_app(self, app):
+        add_statement_hook(_time_statement)
+        self.store_dir = self.store_dir or app.config.get('METRICS_DIR')
+        if self.store_dir and not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        app.before_request(self.start)
+        # after_request functions run in reverse order of registration: go
+        # first in the list so the request is measured after every other
+        # one, including the transaction commit
+        app.after_request_funcs.setdefault(None, []).insert(0, self.finish)
+        app.add_url_rule(self.path, 'flaskbald_metrics', self.exposition)
+        app.extensions['flaskbald_metrics'] = self
+
+    def start(self):
+        g.metrics_start = time.time()
+        g.metrics_timings = {}
+
+    def finish(self, response):
+        start = getattr(g, 'metrics_start', None)
+        if start is None:
+            return response
+        timings = g.metrics_timings
+        g.metrics_start = g.metrics_timings = None
+        self.observe(request.endpoint or 'unmatched', request.method,
+                     response.status_code, time.time() - start, timings)
+        return response
+
+    def observe(self, endpoint, method, status_code, duration, timings):
+        '''Record one finished request.'''
+        status = '{0}xx'.format(status_code // 100)
+        endpoint_labels = (('endpoint', endpoint),)
+        with self._lock:
+            if self.pid != os.getpid():
+                # forked worker: drop the values inherited from the parent
+                self._reset()
+            counters = self.counters
+            key = ('flaskbald_requests_total',
+                   endpoint_labels + (('method', method), ('status', status)))
+            counters[key] = counters.get(key, 0) + 1
+            for kind in TIMINGS:
+                if kind in timings:
+                    key = ('flaskbald_{0}_seconds_total'.format(kind), endpoint_labels)
+                    counters[key] = counters.get(key, 0.0) + timings[kind]
+            if 'queries' in timings:
+                key = ('flaskbald_sql_queries_total', endpoint_labels)
+                counters[key] = counters.get(key, 0) + timings['queries']
+
+            key = ('flaskbald_request_duration_seconds', endpoint_labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += duration
+            histogram[2] += 1
+
+            if self.store_dir and time.time() - self.flushed >= self.flush_interval:
+                self.flush()
+
+    def snapshot(self):
+        '''This process's values as a JSON-serializable dict.'''
+        return _snapshot(self.buckets, self.counters, self.histograms)
+
+    def filename(self):
+        '''Name of this process's file in the store directory.'''
+        return 'metrics-{0}-{1}.json'.format(self.pid, self.started)
+
+    def flush(self):
+        '''Write this process's snapshot to the store directory.'''
+        path = os.path.join(self.store_dir, self.filename())
+        temp = '{0}.tmp'.format(path)
+        with open(temp, 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.rename(temp, path)
+        self.flushed = time.time()
+
+    @contextmanager
+    def _store_lock(self):
+        with open(os.path.join(self.store_dir, 'metrics.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def prune(self):
+        '''
+        Fold the files of worker processes that have exited into the
+        ``metrics-archive.json`` file, so their counts are kept but the
+        store directory doesn't grow with every worker ever started.
+        '''
+        with self._store_lock():
+            self._prune()
+
+    def _prune(self):
+        # called with the store lock held, so two collectors never fold
+        # the same file twice
+        dead = []
+        for path in glob.glob(os.path.join(self.store_dir, 'metrics-*.json')):
+            name = os.path.basename(path)[len('metrics-'):-len('.json')]
+            pid, _, started = name.partition('-')
+            if pid.isdigit() and started and not _alive(int(pid), started):
+                dead.append(path)
+        if not dead:
+            return
+        archive = os.path.join(self.store_dir, ARCHIVE)
+        counters, histograms = self._sum(self._load([archive] + dead))
+        temp = '{0}.tmp'.format(archive)
+        with open(temp, 'w') as snapshot_file:
+            json.dump(_snapshot(self.buckets, counters, histograms), snapshot_file)
+        os.rename(temp, archive)
+        for path in dead:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _load(self, paths):
+        snapshots = []
+        for path in paths:
+            try:
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (IOError, ValueError):
+                continue
+        return snapshots
+
+    def _sum(self, snapshots):
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            if snapshot['buckets'] != list(self.buckets):
+                continue
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+        return counters, histograms
+
+    def collect(self):
+        '''
+        Sum the snapshots of all worker processes (just this one without a
+        store directory) into counters and histograms dicts, pruning the
+        files of the workers that have exited.
+        '''
+        with self._lock:
+            snapshots = [self.snapshot()]
+            own = os.path.join(self.store_dir or '', self.filename())
+        if self.store_dir:
+            # read under the lock too, or a file could be folded into the
+            # archive between reading the archive and reading the file
+            with self._store_lock():
+                self._prune()
+                paths = glob.glob(os.path.join(self.store_dir, 'metrics-*.json'))
+                snapshots.extend(self._load(path for path in paths if path != own))
+        return self._sum(snapshots)
+
+    def render(self):
+        '''Return the aggregated metrics in the Prometheus text format.'''
+        counters, histograms = self.collect()
+        lines = []
+        for name in sorted(HELP):
+            kind, text = HELP[name]
+            lines.append('# HELP {0} {1}'.format(name, text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            if kind == 'histogram':
+                for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket in zip(self.buckets, buckets):
+                        cumulative += bucket
+                        lines.append('{0}_bucket{{{1}}} {2}'.format(
+                            name, _labels(labels + (('le', repr(bound)),)), cumulative))
+                    lines.append('{0}_bucket{{{1}}} {2}'.format(
+                        name, _labels(labels + (('le', '+Inf'),)), count))
+                    lines.append('{0}_sum{{{1}}} {2!r}'.format(name, _labels(labels), total))
+                    lines.append('{0}_count{{{1}}} {2}'.format(name, _labels(labels), count))
+            else:
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append('{0}{{{1}}} {2!r}'.format(name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def exposition(self):
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
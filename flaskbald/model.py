@@ -1,4 +1,4 @@
-from flask import current_app
+from flask import current_app, has_app_context
 
 # Find the stack on which we want to store the database connection.
 # Starting with Flask 0.9, the _app_ctx_stack is the correct one,
@@ -12,20 +12,31 @@ from flask.ext.sqlalchemy import SQLAlchemy
 
 import sys
 import re
+import copy
 import sqlalchemy as sa
 
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.orm.attributes import (
     instance_state
     )
 from sqlalchemy.orm.util import (
     has_identity
 )
+from flaskbald.cache import LRUCache
 from flaskbald.text import camel_to_underscore, pluralize
 
 # the surrogate_pk template that assures that surrogate primary keys
 # are all the same and ordered with the pk first in the table
 surrogate_pk_template = sa.Column(sa.Integer, nullable=False, primary_key=True)
 
+# default number of rows sent per executemany() call by the bulk methods
+BULK_BATCH_SIZE = 1000
+# default number of rows fetched per keyset page by stream()
+STREAM_BATCH_SIZE = 1000
+# default time-to-live, in seconds, of the __cache__ identity cache entries
+CACHE_TTL = 300
+
 
 def get_models(module):
     models_dict = {}
@@ -54,12 +65,350 @@ def create_dump_engine(app):
     return dump_engine
 
 
+def _batched(rows, batch_size):
+    '''Yield lists of at most `batch_size` items from any iterable.'''
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _row_mapping(model, row):
+    '''
+    Convert a row (a plain dict or a model instance) into a dictionary of
+    column attribute values suitable for the bulk insert/update methods.
+
+    Only attributes actually loaded on an instance are included, so unset
+    columns fall back to their column defaults.
+    '''
+    if isinstance(row, dict):
+        return dict(row)
+    state = instance_state(row)
+    return dict((attr.key, state.dict[attr.key]) for attr in
+                state.mapper.column_attrs if attr.key in state.dict)
+
+
+def _group_by_keys(mappings):
+    '''
+    Group mappings by their key set, since a single executemany() call
+    needs every parameter set to contain the same keys.
+    '''
+    groups = {}
+    for mapping in mappings:
+        groups.setdefault(frozenset(mapping), []).append(mapping)
+    return groups.values()
+
+
+def _last_per_key(mappings, keys):
+    '''
+    Drop the mappings followed by another one with the same values for
+    `keys`, so a single statement never inserts or updates a row twice.
+    Mappings missing a key value (e.g. an autoincrement id) are all kept.
+    '''
+    def key_of(mapping):
+        return tuple(mapping.get(key) for key in keys)
+
+    last = dict((key_of(mapping), index) for index, mapping in enumerate(mappings))
+    return [mapping for index, mapping in enumerate(mappings)
+            if None in key_of(mapping) or last[key_of(mapping)] == index]
+
+
+class Row(object):
+    '''
+    Base class for the compact, read-only records returned by
+    :py:meth:`Model.rows`. Subclasses are created per set of field names
+    by :py:func:`row_class`.
+    '''
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, values):
+        for name, value in zip(self._fields, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'{0}' is read-only".format(type(self).__name__))
+
+    __delattr__ = __setattr__
+
+    def __getitem__(self, index):
+        return getattr(self, self._fields[index])
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        return (isinstance(other, Row) and self._fields == other._fields and
+                tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._fields, tuple(self)))
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(name, getattr(self, name)) for name in self._fields))
+
+    def __reduce__(self):
+        return _make_row, (self._fields, tuple(self))
+
+    def to_dict(self):
+        '''Return the record as a plain dictionary.'''
+        return dict((name, getattr(self, name)) for name in self._fields)
+
+
+_row_classes = {}
+
+
+def row_class(fields):
+    '''Return the (cached) Row subclass for a tuple of field names.'''
+    fields = tuple(fields)
+    cls = _row_classes.get(fields)
+    if cls is None:
+        cls = _row_classes.setdefault(fields, type(
+            'Row', (Row,), {'__slots__': fields, '_fields': fields}))
+    return cls
+
+
+def _make_row(fields, values):
+    return row_class(fields)(values)
+
+
+def _nullable(column):
+    return getattr(getattr(column, 'expression', column), 'nullable', True)
+
+
+def _keyset_order(columns):
+    '''
+    ORDER BY terms for keyset pagination on `columns`, ascending, with
+    NULLs sorting last in nullable columns on every database.
+    '''
+    order = []
+    for column in columns:
+        if _nullable(column):
+            order.append(column.is_(None))
+        order.append(column)
+    return order
+
+
+def _keyset_after(columns, values):
+    '''
+    Build the keyset criterion selecting rows that sort strictly after
+    `values` in the order of :py:func:`_keyset_order`:
+    (c1 > v1) OR (c1 = v1 AND c2 > v2) OR ...
+    where a NULL sorts after every value and equals only NULL.
+    '''
+    clauses = []
+    equal = []
+    for column, value in zip(columns, values):
+        if value is None:
+            # nothing sorts after a NULL within this column
+            equal.append(column.is_(None))
+            continue
+        after = column > value
+        if _nullable(column):
+            after = sa.or_(after, column.is_(None))
+        clauses.append(sa.and_(*(equal + [after])))
+        equal.append(column == value)
+    return sa.or_(*clauses)
+
+
+def _unique_keys(mapper):
+    '''
+    Return the sets of attribute keys that identify at most one row: the
+    primary key plus every unique column, constraint and index.
+    '''
+    def attr_keys(columns):
+        try:
+            return frozenset(mapper.get_property_by_column(col).key
+                             for col in columns)
+        except sa.orm.exc.UnmappedColumnError:
+            return None
+
+    table = mapper.local_table
+    keysets = [attr_keys(mapper.primary_key)]
+    keysets.extend(attr_keys([col]) for col in table.columns if col.unique)
+    keysets.extend(attr_keys(constraint.columns) for constraint in
+                   table.constraints if isinstance(constraint, sa.UniqueConstraint))
+    keysets.extend(attr_keys(index.columns) for index in table.indexes
+                   if index.unique)
+    return set(keys for keys in keysets if keys)
+
+
+def _cache_snapshot(obj):
+    '''
+    Copy the loaded column values of a clean instance for the identity
+    cache. Returns None if the instance is modified or partially loaded.
+    '''
+    state = instance_state(obj)
+    if state.modified:
+        return None
+    values = {}
+    for attr in state.mapper.column_attrs:
+        if attr.key not in state.dict:
+            return None
+        values[attr.key] = state.dict[attr.key]
+    return type(obj), copy.deepcopy(values)
+
+
 def create_model(db):
 
+    # per-model identity caches and unique keys, created on first use
+    identity_caches = {}
+    unique_keys = {}
+    # baked (compiled) load queries keyed by model and where-clause shape
+    bakery = baked.bakery(size=500)
+    baked_queries = {}
+
+    def model_cache(model):
+        config = getattr(model, '__cache__', None)
+        if not config:
+            return None
+        cache = identity_caches.get(model)
+        if cache is None:
+            ttl = config.get('ttl', CACHE_TTL)
+            if not 0 < ttl < float('inf'):
+                raise ValueError("{0}.__cache__ needs a finite, positive ttl".format(
+                    model.__name__))
+            cache = identity_caches.setdefault(model, LRUCache(
+                max_entries=config.get('max_entries', 1000), ttl=ttl))
+        return cache
+
+    def invalidate_cached(identities):
+        for model, identity in identities:
+            for cached_model, cache in identity_caches.items():
+                if issubclass(model, cached_model):
+                    cache.invalidate_tag(identity)
+
+    def clear_cached(models):
+        for model in models:
+            for cached_model, cache in identity_caches.items():
+                if issubclass(model, cached_model) or issubclass(cached_model, model):
+                    cache.clear()
+
+    @sa.event.listens_for(db.session, 'after_bulk_update')
+    @sa.event.listens_for(db.session, 'after_bulk_delete')
+    def clear_after_bulk(context):
+        # Query.update() / delete() don't say which rows they changed, so
+        # drop the model's whole cache
+        if not identity_caches:
+            return
+        model = context.mapper.class_
+        clear_cached([model])
+        context.session.info.setdefault('identity_cache_clear', set()).add(model)
+
+    @sa.event.listens_for(db.session, 'after_flush')
+    def invalidate_after_flush(session, flush_context):
+        if not identity_caches:
+            return
+        identities = [(type(obj), tuple(instance_state(obj).identity))
+                      for obj in list(session.dirty) + list(session.deleted)
+                      if model_cache(type(obj)) is not None and has_identity(obj)]
+        if identities:
+            invalidate_cached(identities)
+            session.info.setdefault('identity_cache_pending', []).extend(identities)
+
+    @sa.event.listens_for(db.session, 'after_commit')
+    def invalidate_after_commit(session):
+        # invalidate again in case another request re-cached the old row
+        # between the flush and the commit
+        invalidate_cached(session.info.pop('identity_cache_pending', ()))
+        clear_cached(session.info.pop('identity_cache_clear', ()))
+
+    @sa.event.listens_for(db.session, 'after_rollback')
+    def discard_pending(session):
+        session.info.pop('identity_cache_pending', None)
+        session.info.pop('identity_cache_clear', None)
+
+    class Query(db.Query):
+        '''Query class returned by the Model load/filter/query methods.'''
+
+        def stream(self, batch_size=STREAM_BATCH_SIZE, order_by=None):
+            '''
+            Iterate over the results of this query in pages of `batch_size`
+            rows, using keyset pagination on `order_by` (a column, attribute
+            name or list of them, ascending) with the primary key as the
+            tiebreaker, instead of OFFSET. NULLs in a nullable `order_by`
+            column sort last. A limit() or offset() set on the query is
+            honored: it caps the total number of rows streamed and skips
+            rows before the first page.
+
+            Each page is streamed with a server-side cursor where the driver
+            supports it. Once a page has been consumed the session is flushed
+            and the page's objects are expunged, so memory stays flat
+            regardless of the number of rows. Do not rely on streamed
+            objects staying attached to the session.
+            '''
+            model = self.column_descriptions[0]['entity']
+            mapper = sa.inspect(model)
+            if order_by is None:
+                order_by = []
+            elif not isinstance(order_by, (list, tuple)):
+                order_by = [order_by]
+            columns = [getattr(model, col) if isinstance(col, basestring) else col
+                       for col in order_by]
+            keys = [col.key for col in columns]
+            for col in mapper.primary_key:
+                key = mapper.get_property_by_column(col).key
+                if key not in keys:
+                    columns.append(getattr(model, key))
+                    keys.append(key)
+
+            # a limit set by the caller caps the total, an offset only
+            # applies to the first page
+            remaining, offset = self._limit, self._offset
+            query = self.limit(None).offset(None).order_by(None)
+            query = query.order_by(*_keyset_order(columns))
+            bind = self.session.get_bind(mapper=mapper, clause=query.statement)
+            if bind.dialect.supports_server_side_cursors:
+                query = query.yield_per(batch_size)
+
+            last = None
+            while remaining is None or remaining > 0:
+                size = batch_size if remaining is None else min(batch_size, remaining)
+                if last is None:
+                    page = query.limit(size).offset(offset)
+                else:
+                    page = query.filter(_keyset_after(columns, last)).limit(size)
+                batch = page.all()
+                for obj in batch:
+                    yield obj
+                if not batch:
+                    return
+                if remaining is not None:
+                    remaining -= len(batch)
+                last = [getattr(batch[-1], name) for name in keys]
+                self.session.flush()
+                for obj in batch:
+                    self.session.expunge(obj)
+                if len(batch) < size:
+                    return
+
     class Model(db.Model):
 
         __abstract__  = True
 
+        query_class = Query
+
+        # opt-in identity cache for get() on unique keys, e.g.
+        # __cache__ = {'ttl': 300, 'max_entries': 1000}
+        # The cache is per process: writes made by other processes (other
+        # workers, scripts) are only seen once the entry's ttl expires.
+        __cache__ = None
+
+        # named relationship loading strategies for load(profile=...), e.g.
+        # __load_profiles__ = {'list': [sa.orm.selectinload('tags')]}
+        __load_profiles__ = {}
+
         id            = db.Column(db.Integer, primary_key=True)
         date_created  = db.Column(db.DateTime,  default=db.func.current_timestamp())
         date_modified = db.Column(db.DateTime,  default=db.func.current_timestamp(),
@@ -142,13 +491,197 @@ def create_model(db):
             db.session.commit()
             return self
 
+        @classmethod
+        def save_many(cls, rows, batch_size=BULK_BATCH_SIZE):
+            '''
+            Inserts many rows (dicts or unsaved instances) in batches of
+            `batch_size` using executemany, without adding the objects to the
+            session or the identity map.
+
+            Columns not present in a row, such as `date_created` and
+            `date_modified`, get their normal column defaults. Like
+            :py:meth:`save` this happens within the current transaction and
+            still needs a commit. Returns the number of rows sent.
+            '''
+            count = 0
+            for batch in _batched(rows, batch_size):
+                mappings = [_row_mapping(cls, row) for row in batch]
+                db.session.bulk_insert_mappings(cls, mappings)
+                count += len(mappings)
+            return count
+
+        @classmethod
+        def update_many(cls, rows, batch_size=BULK_BATCH_SIZE):
+            '''
+            Updates many existing rows (dicts or instances) in batches of
+            `batch_size`. Every row must include its primary key; only the
+            keys present in a row are written.
+
+            Objects already loaded in the session are **not** refreshed.
+            `date_modified` is set to the current timestamp unless a row
+            supplies it. Returns the number of rows sent.
+            '''
+            count = 0
+            for batch in _batched(rows, batch_size):
+                mappings = [_row_mapping(cls, row) for row in batch]
+                db.session.bulk_update_mappings(cls, mappings)
+                count += len(mappings)
+            # bulk updates bypass the flush events
+            cls.clear_cache()
+            return count
+
+        @classmethod
+        def upsert_many(cls, rows, conflict_keys=('id',),
+                        batch_size=BULK_BATCH_SIZE):
+            '''
+            Inserts rows, or updates the existing row when one already
+            matches on `conflict_keys` (which should be covered by a unique
+            constraint).
+
+            PostgreSQL uses a native ``INSERT ... ON CONFLICT DO UPDATE``;
+            other dialects look up the existing keys for each batch and then
+            split it between :py:meth:`update_many` and :py:meth:`save_many`.
+            `date_created` is only set on insert. When a batch holds several
+            rows with the same conflict key, only the last one is sent.
+            Returns the number of rows sent.
+            '''
+            conflict_keys = tuple(conflict_keys)
+            dialect = db.session.get_bind(mapper=sa.inspect(cls)).dialect.name
+            count = 0
+            for batch in _batched(rows, batch_size):
+                mappings = _last_per_key([_row_mapping(cls, row) for row in batch],
+                                         conflict_keys)
+                if dialect == 'postgresql':
+                    cls._pg_upsert(mappings, conflict_keys)
+                else:
+                    cls._generic_upsert(mappings, conflict_keys)
+                count += len(mappings)
+            cls.clear_cache()
+            return count
+
+        @classmethod
+        def _pg_upsert(cls, mappings, conflict_keys):
+            from sqlalchemy.dialects.postgresql import insert
+            table = cls.__table__
+            for group in _group_by_keys(mappings):
+                stmt = insert(table)
+                update_set = dict((key, stmt.excluded[key]) for key in group[0]
+                                  if key not in conflict_keys and
+                                  key != 'date_created')
+                update_set.setdefault('date_modified', sa.func.current_timestamp())
+                stmt = stmt.on_conflict_do_update(index_elements=conflict_keys,
+                                                  set_=update_set)
+                db.session.execute(stmt, group)
+
+        @classmethod
+        def _generic_upsert(cls, mappings, conflict_keys):
+            mapper = sa.inspect(cls)
+            pk_keys = [mapper.get_property_by_column(col).key
+                       for col in mapper.primary_key]
+            key_columns = [getattr(cls, key) for key in conflict_keys]
+
+            def key_of(mapping):
+                return tuple(mapping.get(key) for key in conflict_keys)
+
+            wanted = set(key_of(mapping) for mapping in mappings)
+            if len(conflict_keys) == 1:
+                criteria = key_columns[0].in_([key[0] for key in wanted])
+            else:
+                criteria = sa.or_(*[sa.and_(*[col == value for col, value in
+                                              zip(key_columns, key)])
+                                    for key in wanted])
+            pk_columns = [getattr(cls, key) for key in pk_keys]
+            existing = dict((tuple(found[len(pk_keys):]), found[:len(pk_keys)])
+                            for found in db.session.query(*(pk_columns + key_columns)
+                                                          ).filter(criteria))
+
+            inserts, updates = [], []
+            for mapping in mappings:
+                pk = existing.get(key_of(mapping))
+                if pk is None:
+                    inserts.append(mapping)
+                else:
+                    mapping.pop('date_created', None)
+                    mapping.update(zip(pk_keys, pk))
+                    updates.append(mapping)
+            if updates:
+                cls.update_many(updates, batch_size=len(updates))
+            if inserts:
+                cls.save_many(inserts, batch_size=len(inserts))
+
         @classmethod
         def get(cls, **where):
             '''
             A convenience method that constructs a load query with keyword
             arguments as the filter arguments and return a single instance.
+
+            When the model sets `__cache__` and the keyword arguments form a
+            unique key, the row is served from the in-process identity
+            cache when possible. Cache entries are invalidated when the row
+            is flushed or committed through this process's session; changes
+            made by other processes show up once the entry expires (after
+            the `__cache__` ttl, :py:data:`CACHE_TTL` seconds by default).
+            '''
+            cache = model_cache(cls)
+            if cache is None or not where:
+                return cls.baked_load(**where).one()
+            if cls not in unique_keys:
+                unique_keys[cls] = _unique_keys(sa.inspect(cls))
+            if frozenset(where) not in unique_keys[cls]:
+                return cls.baked_load(**where).one()
+            key = tuple(sorted(where.items()))
+            try:
+                cached = cache.get(key)
+            except TypeError:
+                return cls.baked_load(**where).one()
+            if cached is not None:
+                return cls._from_cache(*cached)
+
+            instance = cls.baked_load(**where).one()
+            snapshot = _cache_snapshot(instance)
+            if snapshot is not None:
+                identity = tuple(instance_state(instance).identity)
+                cache.set(key, snapshot, tags=[identity])
+            return instance
+
+        @classmethod
+        def _from_cache(cls, model, values):
             '''
-            return cls.load(**where).one()
+            Attach a cached row to the current session as a persistent
+            instance without querying the database.
+            '''
+            mapper = sa.inspect(model)
+            session = db.session()
+            identity = mapper.identity_key_from_primary_key(
+                [values[mapper.get_property_by_column(col).key]
+                 for col in mapper.primary_key])
+            existing = session.identity_map.get(identity)
+            if existing is not None:
+                return existing
+            instance = mapper.class_manager.new_instance()
+            state = instance_state(instance)
+            state.dict.update(copy.deepcopy(values))
+            make_transient_to_detached(instance)
+            session.add(instance)
+            # run load listeners (e.g. Mutable coercion) as a query would
+            state.manager.dispatch.load(state, None)
+            return instance
+
+        @classmethod
+        def cache_stats(cls):
+            '''
+            Return hit/miss counters and size of this model's identity cache,
+            or None if the model doesn't set `__cache__`.
+            '''
+            cache = model_cache(cls)
+            return cache.stats() if cache is not None else None
+
+        @classmethod
+        def clear_cache(cls):
+            '''Drop every entry from this model's identity cache.'''
+            cache = model_cache(cls)
+            if cache is not None:
+                cache.clear()
 
         @classmethod
         def all(cls, **where):
@@ -158,21 +691,145 @@ def create_model(db):
 
             all() without arguments returns all the items of the model type.
             '''
-            return cls.load(**where).all()
+            return cls.baked_load(**where).all()
 
         @classmethod
-        def load(cls, **where):
+        def count(cls, **where):
+            '''
+            Return the number of stored objects matching the keyword
+            filter arguments using ``SELECT COUNT(*)``, without loading any
+            instances.
+            '''
+            query = db.session.query(sa.func.count()).select_from(cls)
+            if where:
+                query = query.filter_by(**where)
+            return query.scalar()
+
+        @classmethod
+        def exists(cls, **where):
+            '''
+            Return True if any stored object matches the keyword filter
+            arguments using ``SELECT EXISTS (...)``, without loading any
+            instances.
+            '''
+            return db.session.query(cls.load(**where).exists()).scalar()
+
+        @classmethod
+        def pluck(cls, column, **where):
+            '''
+            Return a list with the values of a single column (an attribute
+            name or column) for the objects matching the keyword filter
+            arguments, without loading any instances.
+            '''
+            if isinstance(column, basestring):
+                column = getattr(cls, column)
+            return [row[0] for row in cls.load(**where).with_entities(column)]
+
+        @classmethod
+        def rows(cls, *columns, **where):
+            '''
+            Return the given columns (attribute names or columns; all
+            mapped columns by default) of the objects matching the keyword
+            filter arguments as compact read-only :py:class:`Row` records
+            built straight from the cursor, skipping ORM instances, the
+            identity map and change tracking.
+
+            Use `to_dict()` on a record (:py:func:`json_response` does this
+            automatically) to serialize it.
+            '''
+            if not columns:
+                columns = [attr.key for attr in sa.inspect(cls).column_attrs]
+            columns = [getattr(cls, col) if isinstance(col, basestring) else col
+                       for col in columns]
+            record = row_class(col.key for col in columns)
+            statement = cls.load(**where).with_entities(*columns).statement
+            result = db.session.execute(statement, mapper=sa.inspect(cls))
+            return [record(row) for row in result]
+
+        @classmethod
+        def baked_load(cls, **where):
+            '''
+            Like :py:meth:`load`, but the SQL for each model and shape of
+            keyword arguments is built and compiled once and cached, so
+            repeat calls only bind the new parameter values.
+
+            Returns a baked result supporting `one()`, `first()` and `all()`
+            rather than a query object. Arguments that can't be bound as
+            column parameters (e.g. relationships), and models overriding
+            :py:meth:`load` (e.g. to add a soft-delete filter), fall back
+            to :py:meth:`load`.
+            '''
+            if cls.load.__func__ is not Model.load.__func__:
+                return cls.load(**where)
+            mapper = sa.inspect(cls)
+            columns = mapper.column_attrs
+            if 'profile' in where or any(key not in columns for key in where):
+                return cls.load(**where)
+            # `col = NULL` never matches, so None values are part of the
+            # shape and compiled to IS NULL
+            shape = tuple(sorted((key, value is None)
+                                 for key, value in where.iteritems()))
+            bq = baked_queries.get((cls, shape))
+            if bq is None:
+                criteria = dict((key, None if is_null else
+                                 sa.bindparam('fb_' + key))
+                                for key, is_null in shape)
+                bq = bakery(lambda session: session.query(cls), cls, shape)
+                if criteria:
+                    bq += lambda query: query.filter_by(**criteria)
+                baked_queries[(cls, shape)] = bq
+            return bq(db.session()).params(**dict(
+                ('fb_' + key, value) for key, value in where.iteritems()
+                if value is not None))
+
+        @classmethod
+        def stream(cls, batch_size=STREAM_BATCH_SIZE, order_by=None, **where):
+            '''
+            Iterate over all (or the filtered) items of the model type in
+            keyset-paginated batches without loading the whole table into
+            memory. See :py:meth:`Query.stream`.
+            '''
+            return cls.load(**where).stream(batch_size=batch_size,
+                                            order_by=order_by)
+
+        @classmethod
+        def load_options(cls, profile):
+            '''
+            Return the query loader options for a named profile from
+            `__load_profiles__`.
+
+            In debug mode every relationship the profile doesn't load raises
+            on access instead of lazy loading, so N+1 regressions surface
+            in tests.
+            '''
+            try:
+                options = list(cls.__load_profiles__[profile])
+            except KeyError:
+                raise ValueError("Unknown load profile '{0}' for {1}".format(
+                    profile, cls.__name__))
+            if has_app_context() and current_app.debug:
+                options.append(sa.orm.raiseload('*'))
+            return options
+
+        @classmethod
+        def load(cls, profile=None, **where):
             '''
             Convenience method to build a sqlalchemy query to return stored
             objects.
 
+            `profile` names one of the model's `__load_profiles__` whose
+            loader options are applied to the query.
+
             Returns a query object. This query object must be executed to retrieve
             actual items from the database.
             '''
+            query = cls.query()
+            if profile is not None:
+                query = query.options(*cls.load_options(profile))
             if where:
-                return db.session.query(cls).filter_by(**where)
+                return query.filter_by(**where)
             else:
-                return db.session.query(cls)
+                return query
 
         @classmethod
         def filter(cls, *pargs, **kargs):
@@ -182,7 +839,7 @@ def create_model(db):
 
             Returns a query object.
             '''
-            return db.session.query(cls).filter(*pargs, **kargs)
+            return cls.query().filter(*pargs, **kargs)
 
         @classmethod
         def query(cls):
@@ -190,7 +847,7 @@ def create_model(db):
             Convenience method to return a query based on the current object
             class.
             '''
-            return db.session.query(cls)
+            return cls.query_class(cls, session=db.session())
 
         # @classmethod
         # def show_create_table(cls):
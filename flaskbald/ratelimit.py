@@ -0,0 +1,214 @@
+# encoding: utf-8
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import Blueprint, current_app, request
+from functools import wraps
+from response import APITooManyRequests
+
+# app config key for the shared backend, e.g. 'sqlite:////var/run/app/ratelimit.db'
+RATE_LIMIT_STORAGE = 'RATE_LIMIT_STORAGE'
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate(rate):
+    '''
+    Return (tokens per second, default burst) for a rate given as a number
+    of requests per second or a string such as '100/minute'.
+    '''
+    if isinstance(rate, basestring):
+        count, _, period = rate.partition('/')
+        count = float(count)
+        seconds = PERIODS.get(period.strip().rstrip('s'))
+        if seconds is None:
+            raise ValueError("Unknown rate period: '{0}'".format(rate))
+    else:
+        count, seconds = float(rate), 1
+    if not count > 0:
+        raise ValueError("Rate must be positive: '{0}'".format(rate))
+    return count / seconds, max(count, 1)
+
+
+def refill(tokens, stamp, now, rate, burst, cost):
+    '''
+    Token bucket step: return the bucket's new token count and the seconds
+    to wait before `cost` tokens are available (0 when taken now).
+    '''
+    tokens = min(burst, tokens + (now - stamp) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryBackend(object):
+    '''
+    In-process token buckets, one per key. The least recently used buckets
+    beyond `max_keys` are dropped (which resets them to full).
+    '''
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.time()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (burst, now))
+            tokens, wait = refill(tokens, stamp, now, rate, burst, cost)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBackend(object):
+    '''
+    Token buckets stored in a SQLite database file, shared by every worker
+    process on the host. Each check is one short IMMEDIATE transaction.
+
+    Each row also records when its bucket will be full again; rows past
+    that time are equivalent to a missing row and are deleted every
+    `prune_interval` seconds.
+    '''
+    def __init__(self, path, timeout=5.0, prune_interval=60.0):
+        self.path = path
+        self.timeout = timeout
+        self.prune_interval = prune_interval
+        self.pruned = time.time()
+        self._local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS rate_limit_buckets '
+            '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, stamp REAL NOT NULL, '
+            'full_at REAL NOT NULL)')
+
+    def connection(self):
+        # one connection per thread, reopened after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            # bucket state isn't worth an fsync per request
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, rate, burst, cost=1):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = connection.execute(
+                'SELECT tokens, stamp FROM rate_limit_buckets WHERE key = ?',
+                (key,)).fetchone()
+            tokens, stamp = row if row else (burst, now)
+            tokens, wait = refill(tokens, stamp, now, rate, burst, cost)
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, stamp, full_at) '
+                'VALUES (?, ?, ?, ?)', (key, tokens, now, now + (burst - tokens) / rate))
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        if now - self.pruned >= self.prune_interval:
+            self.prune(now)
+        return wait
+
+    def prune(self, now=None):
+        '''Delete the buckets that have refilled completely.'''
+        self.pruned = now or time.time()
+        self.connection().execute(
+            'DELETE FROM rate_limit_buckets WHERE full_at <= ?', (self.pruned,))
+
+    def reset(self):
+        self.connection().execute('DELETE FROM rate_limit_buckets')
+
+
+def backend_from_config(config):
+    storage = config.get(RATE_LIMIT_STORAGE)
+    if not storage or storage == 'memory':
+        return MemoryBackend()
+    if storage.startswith('sqlite:///'):
+        return SQLiteBackend(storage[len('sqlite:///'):])
+    raise ValueError("Unknown {0}: '{1}'".format(RATE_LIMIT_STORAGE, storage))
+
+
+def current_backend():
+    '''The app's shared rate limit backend, created from its config.'''
+    backend = current_app.extensions.get('flaskbald_rate_limit')
+    if backend is None:
+        backend = current_app.extensions['flaskbald_rate_limit'] = \
+            backend_from_config(current_app.config)
+    return backend
+
+
+def remote_ip():
+    return request.remote_addr
+
+
+def auth_id():
+    '''JWT subject of the logged-in user, or the remote IP when anonymous.'''
+    from auth import get_auth_id
+    sub = get_auth_id()
+    return u'sub:{0}'.format(sub) if sub is not None else remote_ip()
+
+
+KEYS = {'ip': remote_ip, 'user': auth_id}
+
+
+def rate_limit(key='ip', rate=10, burst=None, cost=1, backend=None):
+    '''
+    Limit a view function, or every view of a blueprint when applied to a
+    Blueprint, with a token bucket per client.
+
+    `key` is 'ip', 'user' (the JWT subject from `get_auth_id()`, falling
+    back to the IP) or a function returning the client key. `rate` is in
+    requests per second or a string such as '100/minute'; `burst` is the
+    bucket size (defaults to the request count of the rate). Buckets live
+    in `backend`, or in the app's backend configured by
+    ``RATE_LIMIT_STORAGE`` (in-process, or 'sqlite:///<path>' to share
+    them between worker processes).
+
+    Requests over the limit get an :py:class:`APITooManyRequests` (429)
+    response with a Retry-After header.
+    '''
+    key_func = KEYS.get(key, key) if isinstance(key, basestring) else key
+    if not callable(key_func):
+        raise ValueError("Unknown rate limit key: '{0}'".format(key))
+    tokens_per_second, default_burst = parse_rate(rate)
+    burst = float(burst or default_burst)
+
+    def check(scope):
+        client = key_func()
+        if isinstance(client, str):
+            client = client.decode('utf-8', 'replace')
+        # unicode: JWT subjects and custom keys may be non-ASCII
+        bucket = u'{0}:{1}'.format(scope, client)
+        wait = (backend or current_backend()).take(
+            bucket, tokens_per_second, burst, cost)
+        if wait:
+            return APITooManyRequests('Rate limit exceeded.', retry_after=wait)
+
+    def decorator(target):
+        if isinstance(target, Blueprint):
+            target.before_request(lambda: check(target.name))
+            return target
+
+        @wraps(target)
+        def replacement(*pargs, **kargs):
+            limited = check(request.endpoint)
+            if limited is not None:
+                return limited
+            return target(*pargs, **kargs)
+
+        return replacement
+
+    return decorator
@@ -1,84 +1,200 @@
 # encoding: utf-8
+import hashlib
 import json
+import math
 
-from flask import request, Response, current_app, render_template
+from flask import request, Response, current_app, render_template, stream_with_context
 from webob import Response
 from functools import wraps
 
+from .cache import LRUCache
+from .metrics import timed
 from .template import template_functions
 
 
-def action(orig_func):
+# server-side cache for api_action(cache=<ttl>) responses
+api_cache = LRUCache(max_entries=1000)
+
+# headers of the full response repeated on a 304 (RFC 7232, section 4.1)
+NOT_MODIFIED_HEADERS = ('cache-control', 'content-location', 'expires', 'vary')
+
+# size of the chunks sent by streamed template responses
+TEMPLATE_CHUNK_SIZE = 8 * 1024
+
+# content types accepted by request_stream() and its read size
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonlines',
+                    'application/jsonl')
+REQUEST_STREAM_CHUNK_SIZE = 64 * 1024
+
+# where request_data() keeps the parsed body of the current request
+REQUEST_DATA_KEY = 'flaskbald.request_data'
+
+
+def buffered(pieces, chunk_size=TEMPLATE_CHUNK_SIZE):
+    '''Join the small strings yielded by `pieces` into ~`chunk_size` chunks.'''
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield u''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield u''.join(buffer)
+
+
+def register_template_functions(app):
+    '''
+    Add the template functions to the app's Jinja globals, once, keeping
+    any global of the same name the app already set. create_app does this
+    at setup; the action decorators do it for apps built without it.
+    '''
+    env = app.jinja_env
+    if getattr(env, 'flaskbald_template_functions', False):
+        return
+    for name, function in template_functions.items():
+        env.globals.setdefault(name, function)
+    env.flaskbald_template_functions = True
+
+
+def stream_template(template_name, **context):
+    '''
+    Return a response that renders the template while it is being sent
+    (Jinja's `generate()`), in chunks of about TEMPLATE_CHUNK_SIZE.
+    '''
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_or_select_template(template_name)
+    return current_app.response_class(
+        stream_with_context(buffered(template.generate(context))))
+
+
+def action(orig_func=None, stream=False):
     '''
     Return rendered template with environment data and template functions.
+
+    With `stream=True` the template is rendered while the response is
+    sent instead of being built in memory first.
     '''
-    @wraps(orig_func)
-    def replacement(*args, **kargs):
-        handler_response = orig_func(*args, **kargs)
-        if type(handler_response) is tuple or type(handler_response) is list:
-            current_app.jinja_env.globals.update(**template_functions)
-            template = handler_response[0]
-            data = handler_response[1]
-            if not data or type(data) is not dict:
-                data = dict()
+    def actual_decorator(orig_func):
+        @wraps(orig_func)
+        def replacement(*args, **kargs):
+            handler_response = orig_func(*args, **kargs)
+            if type(handler_response) is tuple or type(handler_response) is list:
+                template = handler_response[0]
+                data = handler_response[1]
+                if not data or type(data) is not dict:
+                    data = dict()
+
+                register_template_functions(current_app)
+                data.update({
+                    'config': current_app.config,
+                    'ENV': current_app.config.get("ENV"),
+                    "HOST_URL": request.host
+                })
+                if stream:
+                    return stream_template(template, **data)
+                with timed('template'):
+                    return render_template(template, **data)
+            else:
+                return handler_response
 
-            data.update({
-                'config': current_app.config,
-                'ENV': current_app.config.get("ENV"),
-                "HOST_URL": request.host
-            })
-            return render_template(template, **data)
-        else:
-            return handler_response
+        return replacement
 
-    return replacement
+    if not orig_func:
+        return actual_decorator
+    else:
+        return actual_decorator(orig_func)
 
 
-def action_v2(orig_func):
+def action_v2(orig_func=None, stream=False):
     '''
     Return rendered template with environment data and template functions and optionally set cookies.
-    '''
-    @wraps(orig_func)
-    def replacement(*args, **kargs):
-        handler_response = orig_func(*args, **kargs)
-        if type(handler_response) is tuple or type(handler_response) is list:
-            current_app.jinja_env.globals.update(**template_functions)
-            template = handler_response[0]
-            data = handler_response[1]
-            if not data or type(data) is not dict:
-                data = dict()
 
-            try:
-                cookies = handler_response[2]
-            except:
-                cookies = None
-
-            data.update({
-                'config': current_app.config,
-                'ENV': current_app.config.get("ENV"),
-                "HOST_URL": request.host
-            })
-
-            if cookies and type(cookies) == dict:
-                resp = current_app.make_response(render_template(template, **data))
-                for cookie_key, cookie_value in cookies.iteritems():
-                    resp.set_cookie(cookie_key, value=cookie_value)
-                return resp
+    With `stream=True` the template is rendered while the response is
+    sent instead of being built in memory first.
+    '''
+    def actual_decorator(orig_func):
+        @wraps(orig_func)
+        def replacement(*args, **kargs):
+            handler_response = orig_func(*args, **kargs)
+            if type(handler_response) is tuple or type(handler_response) is list:
+                template = handler_response[0]
+                data = handler_response[1]
+                if not data or type(data) is not dict:
+                    data = dict()
+
+                try:
+                    cookies = handler_response[2]
+                except:
+                    cookies = None
+
+                register_template_functions(current_app)
+                data.update({
+                    'config': current_app.config,
+                    'ENV': current_app.config.get("ENV"),
+                    "HOST_URL": request.host
+                })
+
+                if stream:
+                    rendered = stream_template(template, **data)
+                else:
+                    with timed('template'):
+                        rendered = render_template(template, **data)
+
+                if cookies and type(cookies) == dict:
+                    resp = current_app.make_response(rendered)
+                    for cookie_key, cookie_value in cookies.iteritems():
+                        resp.set_cookie(cookie_key, value=cookie_value)
+                    return resp
+                else:
+                    return rendered
             else:
-                return render_template(template, **data)
-        else:
-            return handler_response
+                return handler_response
+
+        return replacement
+
+    if not orig_func:
+        return actual_decorator
+    else:
+        return actual_decorator(orig_func)
+
 
-    return replacement
+def is_stream(body):
+    '''True for iterators and generators (such as `Model.stream()`).'''
+    return hasattr(body, '__iter__') and iter(body) is body
 
 
-def json_response(body, status, status_code=200, jwt_cookie=None):
+def json_default(obj):
+    '''See :py:func:`flaskbald.encoder.json_default`.'''
+    from .encoder import json_default
+    return json_default(obj)
+
+
+def json_response(body, status, status_code=200, jwt_cookie=None, stream=None):
     '''
     Return response JSON encoded with proper headers.
+
+    When `body` is an iterator or generator (or `stream` is True), the
+    response body is streamed: items are encoded one at a time while the
+    response is sent, so memory doesn't grow with the number of items. An
+    error raised mid-stream can only truncate the response.
     '''
-    resp = Response(json.dumps({"status": "success", "data": body}),
-                    status=status, content_type="application/json",
-                    charset='utf-8')
+    # imported here: encoder pulls in the database layer for its model types
+    from . import encoder
+    if stream is None:
+        stream = is_stream(body)
+    if stream:
+        resp = Response(app_iter=stream_with_context(encoder.iter_envelope(body)),
+                        status=status, content_type="application/json",
+                        charset='utf-8')
+    else:
+        with timed('json'):
+            encoded = encoder.dumps({"status": "success", "data": body})
+        resp = Response(encoded,
+                        status=status, content_type="application/json",
+                        charset='utf-8')
 
     # resp = Response(json.dumps({"status": "success", "data": body}))
     # resp.status_code = status_code
@@ -101,7 +217,59 @@ def json_response(body, status, status_code=200, jwt_cookie=None):
     return resp
 
 
-def api_action(orig_func=None, set_jwt_cookie=False):
+def body_etag(body):
+    '''Strong ETag value for a serialized response body.'''
+    return hashlib.sha1(body).hexdigest()
+
+
+def conditional_response(resp, etag):
+    '''
+    Set the ETag of `resp`, or return a body-less 304 instead when the
+    request's If-None-Match already matches it. The 304 keeps the headers
+    of `resp` that describe the representation (Vary, caching and CORS).
+    '''
+    if request.if_none_match.contains_weak(etag):
+        not_modified = Response(status='304 Not Modified')
+        for name, value in resp.headerlist:
+            if name.lower() in NOT_MODIFIED_HEADERS or \
+                    name.lower().startswith('access-control-'):
+                not_modified.headers.add(name, value)
+        not_modified.etag = etag
+        return not_modified
+    resp.etag = etag
+    return resp
+
+
+def api_cache_key():
+    '''
+    Cache key for the current request: route, view arguments, query string
+    and the JWT subject of the logged-in user.
+    '''
+    from .auth import get_auth_id
+    return (request.url_rule.rule if request.url_rule else request.path,
+            tuple(sorted((request.view_args or {}).items())),
+            tuple(sorted(request.args.items(multi=True))),
+            get_auth_id())
+
+
+def invalidate_api_cache(*tags):
+    '''
+    Drop the api_action responses cached under any of `tags` (endpoint
+    names or the tags given to `api_action(cache_tags=...)`), or all of
+    them when called without tags. Call it wherever the underlying data
+    changes, e.g. from a model's save():
+
+        def save(self, flush=False):
+            invalidate_api_cache('user:{0}'.format(self.id))
+            return super(User, self).save(flush=flush)
+    '''
+    if not tags:
+        api_cache.clear()
+    for tag in tags:
+        api_cache.invalidate_tag(tag)
+
+
+def api_action(orig_func=None, set_jwt_cookie=False, cache=False, cache_tags=()):
     """
     Decorator that wraps an action in API goodness.
 
@@ -109,14 +277,36 @@ def api_action(orig_func=None, set_jwt_cookie=False):
     structure, or raise any ApiException (which will be wrapped in a
     standard JSON structure).
 
+    With `cache=True`, GET responses carry a strong ETag computed from the
+    body and requests whose If-None-Match matches it get a 304. With
+    `cache=<seconds>` responses are also kept that long in `api_cache`,
+    keyed by `api_cache_key()` and tagged with the endpoint name plus
+    `cache_tags` (a list, or a callable taking the view arguments) for
+    :py:func:`invalidate_api_cache`.
+
     """
+    ttl = None if isinstance(cache, bool) else cache
+
     def actual_decorator(orig_func):
         @wraps(orig_func)
         # @cross_origin()
         def replacement(*args, **kargs):
+            cacheable = (cache and not set_jwt_cookie
+                         and request.method in ('GET', 'HEAD'))
+            key = None
+            if cacheable and ttl:
+                key = api_cache_key()
+                cached = api_cache.get(key)
+                if cached is not None:
+                    resp, etag = cached
+                    return conditional_response(resp.copy(), etag)
+
             try:
                 handler_response = orig_func(*args, **kargs)
             except APIError as api_error_response:
+                # imported here: transaction pulls in the database layer
+                from .transaction import mark_failed
+                mark_failed()
                 return api_error_response
 
             # return the response or reformat for proper response
@@ -126,7 +316,16 @@ def api_action(orig_func=None, set_jwt_cookie=False):
                 jwt_cookie = None
                 if set_jwt_cookie and handler_response.get('token'):
                     jwt_cookie = {'token': handler_response.get('token')}
-                return json_response(handler_response, status='200 OK', jwt_cookie=jwt_cookie)
+                resp = json_response(handler_response, status='200 OK', jwt_cookie=jwt_cookie)
+
+            if not cacheable or not isinstance(resp.app_iter, list):
+                return resp
+            etag = body_etag(resp.body)
+            if key is not None:
+                tags = cache_tags(**kargs) if callable(cache_tags) else cache_tags
+                api_cache.set(key, (resp.copy(), etag), ttl=ttl,
+                              tags=[request.endpoint] + list(tags))
+            return conditional_response(resp, etag)
         return replacement
 
 
@@ -142,9 +341,29 @@ def request_data():
     '''
     Retrieve the data from this Flask app's context,
     decode and return as Python dict.
+
+    The body is parsed once per request; later calls return the same
+    object. Bodies larger than ``REQUEST_DATA_MAX_SIZE`` (defaulting to
+    ``MAX_CONTENT_LENGTH``) raise :py:class:`APIPayloadTooLarge` before
+    being read.
     '''
-    from flask import request
-    data = request.get_data()
+    if REQUEST_DATA_KEY in request.environ:
+        return request.environ[REQUEST_DATA_KEY]
+
+    max_size = current_app.config.get('REQUEST_DATA_MAX_SIZE',
+                                      current_app.config.get('MAX_CONTENT_LENGTH'))
+    length = request.content_length
+    too_large = 'Request body is larger than {0} bytes.'.format(max_size)
+    if max_size is not None and length is not None and length > max_size:
+        raise APIPayloadTooLarge(too_large)
+    if max_size is not None and length is None:
+        # unknown length: read no more than one byte over the limit
+        data = request.stream.read(max_size + 1)
+        if len(data) > max_size:
+            raise APIPayloadTooLarge(too_large)
+    else:
+        data = request.get_data()
+
     if data is None:
         data = {}
     else:
@@ -152,9 +371,71 @@ def request_data():
             data = json.loads(data)
         except ValueError:
             data = {}
+    request.environ[REQUEST_DATA_KEY] = data
     return data
 
 
+def ndjson_lines(stream, max_line, chunk_size=REQUEST_STREAM_CHUNK_SIZE):
+    '''
+    Yield the lines of a newline-delimited stream, reading it `chunk_size`
+    bytes at a time. Lines longer than `max_line` bytes raise
+    :py:class:`APIPayloadTooLarge`.
+    '''
+    def too_long():
+        return APIPayloadTooLarge(
+            'Request line is longer than {0} bytes.'.format(max_line))
+
+    def checked(line):
+        if max_line and len(line) > max_line:
+            raise too_long()
+        return line
+
+    partial = []
+    partial_size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = chunk.split(b'\n')
+        if len(lines) > 1:
+            partial.append(lines[0])
+            yield checked(b''.join(partial))
+            for line in lines[1:-1]:
+                yield checked(line)
+            partial = []
+            partial_size = 0
+        partial.append(lines[-1])
+        partial_size += len(lines[-1])
+        # don't buffer an overlong line until its end
+        if max_line and partial_size > max_line:
+            raise too_long()
+    if partial_size:
+        yield checked(b''.join(partial))
+
+
+def request_stream():
+    '''
+    Iterate over the JSON documents of an ``application/x-ndjson`` request
+    body, parsing them as they are read from the WSGI input so that memory
+    use is bounded by the longest line (at most
+    ``REQUEST_STREAM_MAX_LINE`` bytes, 1MB by default), not by the size
+    of the upload. Blank lines are skipped.
+
+    The body is consumed as it is read and not kept: `request.get_data()`,
+    `request.data` or :py:func:`request_data` return an empty body after
+    (or during) iteration.
+    '''
+    if request.mimetype not in NDJSON_MIMETYPES:
+        raise APIBadRequest('Expected an application/x-ndjson request body.')
+    max_line = current_app.config.get('REQUEST_STREAM_MAX_LINE', 1024 * 1024)
+    for number, line in enumerate(ndjson_lines(request.stream, max_line), 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            raise APIBadRequest('Invalid JSON on line {0}: {1}'.format(number, error))
+
 
 class APIException(Exception):
     '''Base exception class for all API exceptions'''
@@ -213,6 +494,24 @@ class APIResourceConflict(APIError):
     http_status = 409
 
 
+class APIPayloadTooLarge(APIError):
+    http_status = 413
+
+
+class APITooManyRequests(APIError):
+    '''
+    Rate limit exceeded. `retry_after` (seconds) is sent in the
+    Retry-After header.
+    '''
+    http_status = 429
+
+    def __init__(self, message=None, retry_after=None, *pargs, **kargs):
+        super(APITooManyRequests, self).__init__(message, *pargs, **kargs)
+        self.retry_after = retry_after
+        if retry_after is not None:
+            self.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+
+
 class APIUserUnsubscribed(APIUnauthorized):
     """
     Indicates that the targeted User account is no longer
@@ -0,0 +1,116 @@
+# encoding: utf-8
+import logging
+import sqlalchemy as sa
+from flask import current_app, has_request_context, request
+from db_ext import db
+
+log = logging.getLogger(__name__)
+
+# transaction policies
+READ_ONLY = 'read_only'
+AUTO = 'auto'
+MANUAL = 'manual'
+POLICIES = (READ_ONLY, AUTO, MANUAL)
+
+# app config key for the default policy
+TRANSACTION_POLICY = 'TRANSACTION_POLICY'
+
+# per-request state, kept in the WSGI environ: `g` belongs to the app
+# context, which can outlive a request (tests, CLI, app_context() blocks)
+POLICY_KEY = 'flaskbald.transaction_policy'
+FAILED_KEY = 'flaskbald.transaction_failed'
+
+
+def transaction_policy(policy):
+    '''
+    Set the transaction policy of a view function, or the default for
+    every view of a blueprint when applied to a Blueprint.
+
+    * ``auto``: commit at the end of the request if anything was written,
+      roll back if the handler raised.
+    * ``read_only``: never commit; transactions are started read-only on
+      databases that support it (PostgreSQL, MySQL).
+    * ``manual``: the handler commits itself; anything left uncommitted is
+      rolled back at the end of the request.
+    '''
+    if policy not in POLICIES:
+        raise ValueError("Unknown transaction policy: '{0}'".format(policy))
+
+    def decorator(target):
+        target.transaction_policy = policy
+        return target
+
+    return decorator
+
+
+def current_policy():
+    '''Return the transaction policy of the current request's view.'''
+    policy = request.environ.get(POLICY_KEY)
+    if policy is not None:
+        return policy
+    view = current_app.view_functions.get(request.endpoint)
+    policy = getattr(view, 'transaction_policy', None)
+    if policy is None and request.blueprint:
+        blueprint = current_app.blueprints.get(request.blueprint)
+        policy = getattr(blueprint, 'transaction_policy', None)
+    policy = policy or current_app.config.get(TRANSACTION_POLICY, AUTO)
+    request.environ[POLICY_KEY] = policy
+    return policy
+
+
+def mark_failed():
+    '''
+    Record that the current request's handler raised, so its transaction is
+    rolled back even if the error was turned into a response.
+    '''
+    if has_request_context():
+        request.environ[FAILED_KEY] = True
+
+
+def request_failed(sender, exception=None, **extra):
+    '''
+    got_request_exception receiver: an unhandled exception fails the
+    transaction even though the 500 response still runs after_request.
+    '''
+    mark_failed()
+
+
+def commit_request(response):
+    '''
+    after_request hook: commit the session under the ``auto`` policy if it
+    may have written anything and the handler didn't fail. Failed requests
+    (including any 5xx response) are rolled back. A session that was never
+    used, or only read, costs nothing.
+    '''
+    if not db.session.registry.has():
+        return response
+    session = db.session()
+    policy = current_policy()
+    if request.environ.get(FAILED_KEY) or response.status_code >= 500:
+        session.rollback()
+    elif policy == AUTO:
+        if session.has_writes():
+            session.commit()
+    elif policy == READ_ONLY and session.has_writes():
+        log.warning("Discarding writes in read-only request: {0} {1}".format(
+            request.method, request.path))
+    return response
+
+
+def end_request(exc=None):
+    '''
+    teardown_request hook: roll back whatever wasn't committed (including
+    after an unhandled exception) and release the session.
+    '''
+    if not db.session.registry.has():
+        return
+    db.session.close()
+    db.session.remove()
+
+
+@sa.event.listens_for(db.session, 'after_begin')
+def _read_only_transaction(session, transaction, connection):
+    if not has_request_context() or request.endpoint is None:
+        return
+    if current_policy() == READ_ONLY and connection.dialect.name in ('postgresql', 'mysql'):
+        connection.execute('SET TRANSACTION READ ONLY')